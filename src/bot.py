@@ -26,8 +26,8 @@ import db as DB
 
 from util import *
 import util.resources as res
-from typing import Dict, List, Optional
-from services import EventService, RankingService, RoleService, StatService, UserService
+from typing import Dict, List, Optional, Set
+from services import EventService, MemberService, RankingService, RoleService, StatService, UserService
 
 log = logging.getLogger('overlord-bot')
 
@@ -37,7 +37,20 @@ log = logging.getLogger('overlord-bot')
 
 def after_initialized(func):
     async def _func(self, *args, **kwargs):
-        await self.init_lock()
+        # Buffered until bot is ready
+        if not self.initialized():
+            self.defer_event(func, *args, **kwargs)
+            return
+        # Handlers do DB work via run_async, each call is own unit of work
+        return await func(self, *args, **kwargs)
+    return _func
+
+def after_sync(func):
+    async def _func(self, *args, **kwargs):
+        # Buffered until users are synced
+        if self.awaiting_sync():
+            self.defer_event(func, *args, **kwargs)
+            return
         return await func(self, *args, **kwargs)
     return _func
 
@@ -77,8 +90,7 @@ def event_config(name: str):
 #############################
 
 class Overlord(discord.Client):
-    __async_lock: asyncio.Lock
-    __initialized: bool
+    __ready: asyncio.Event
     __awaiting_sync: bool
     __awaiting_sync_last_updated: datetime
 
@@ -92,6 +104,12 @@ class Overlord(discord.Client):
     config: ConfigView
     db: DB.DBSession
 
+    # Write-behind event queue
+    queue: DB.IngestQueue
+
+    # Events received before ready or during sync
+    event_buffer: EventBuffer
+
     # Values initiated on_ready
     guild: discord.Guild
     control_channel: discord.TextChannel
@@ -99,18 +117,32 @@ class Overlord(discord.Client):
     me: discord.Member
 
     # Services
+    s_members: MemberService
     s_users: UserService
     s_roles: RoleService
     s_events: EventService
     s_stats: StatService
     s_ranking: RankingService
 
+    # Role changes
+    role_scheduler: RoleMutationScheduler
+    rank_updates: DebounceScheduler
+    __rank_sweep: asyncio.Lock
+    __closing: bool
+    __rank_touched: Set[int]
+
+    # Keyed and guild-wide locks
+    locks: LockManager
+
     # Scheduled tasks
     tasks: List[asyncio.AbstractEventLoop]
 
     def __init__(self, config: ConfigView, db_session: DB.DBSession):
-        self.__async_lock = asyncio.Lock()
-        self.__initialized = False
+        self.locks = LockManager()
+        self.__rank_sweep = asyncio.Lock()
+        self.__rank_touched = set()
+        self.__closing = False
+        self.__ready = asyncio.Event()
         self.__awaiting_sync = True
         self.__awaiting_sync_last_updated = datetime.now()
         self.tasks = []
@@ -139,19 +171,34 @@ class Overlord(discord.Client):
         self.error_channel = None
         self.me = None
 
+        # Write-behind event queue
+        self.queue = DB.IngestQueue(self.db, capacity=self.config["ingest.capacity"], batch_size=self.config["ingest.batch_size"])
+        self.event_buffer = EventBuffer(self.config["ingest.buffer_size"])
+
         # Services
+        self.s_members = MemberService(cache_size=self.config["cache.members.size"], ttl=self.config["cache.members.ttl"])
         self.s_roles = RoleService(self.db)
-        self.s_users = UserService(self.db, self.s_roles)
-        self.s_events = EventService(self.db)
-        self.s_stats = StatService(self.db, self.s_events)
+        self.s_users = UserService(self.db, self.s_roles, cache_size=self.config["cache.users.size"])
+        self.s_events = EventService(self.db, self.queue,
+                                     message_cache_size=self.config["cache.messages.size"],
+                                     message_filter_capacity=self.config["cache.messages.filter_capacity"])
+        self.s_events.migrate_vc_events()
+        self.s_events.migrate_event_buckets()
+        self.s_stats = StatService(self.db, self.s_events, cache_size=self.config["cache.stats.size"])
         self.s_ranking = RankingService(self.s_stats, self.s_roles, self.config.ranks)
+        self.role_scheduler = RoleMutationScheduler(concurrency=self.config["ranks.scheduler.concurrency"],
+                                                    retries=self.config["ranks.scheduler.retries"])
+        self.rank_updates = DebounceScheduler(self.__update_user_rank_by_did, window=self.config["ranks.scheduler.debounce"])
 
     ###########
     # Getters #
     ###########
 
-    def sync(self) -> asyncio.Lock:
-        return self.__async_lock
+    def sync(self):
+        return self.locks.exclusive()
+
+    def user_sync(self, member_id: int, *resources):
+        return self.locks.acquire(('user', member_id), *resources)
 
     def is_guild_member(self, member: discord.Member) -> bool:
         return member.guild.id == self.guild.id
@@ -172,9 +219,20 @@ class Overlord(discord.Client):
         roles = self.config["control.roles"]
         return len(filter_roles(user, roles)) > 0
 
+    def cache_stats(self) -> Dict[str, LRUCache]:
+        return {
+            'users': self.s_users.cache,
+            'messages': self.s_events.messages,
+            'stats': self.s_stats.cache,
+            'members': self.s_members.cache
+        }
+
     def awaiting_sync(self):
         return self.__awaiting_sync
 
+    def initialized(self) -> bool:
+        return self.__ready.is_set()
+
     def awaiting_sync_elapsed(self):
         if not self.__awaiting_sync:
             return 0
@@ -198,6 +256,10 @@ class Overlord(discord.Client):
     def update_config(self, config: ConfigView):
         self.config = config
         self.s_ranking.config = config.ranks
+        self.role_scheduler.concurrency = config["ranks.scheduler.concurrency"]
+        self.role_scheduler.retries = config["ranks.scheduler.retries"]
+        self.s_members.ttl = config["cache.members.ttl"]
+        self.rank_updates.window = config["ranks.scheduler.debounce"]
         self.check_config()
 
     def set_awaiting_sync(self):
@@ -212,10 +274,34 @@ class Overlord(discord.Client):
     # Async methods #
     #################
 
+    def defer_event(self, handler, *args, **kwargs):
+        self.event_buffer.push((handler, args, kwargs))
+
     async def init_lock(self):
-        while not self.__initialized:
-            await asyncio.sleep(0.1)
-        return
+        await self.__ready.wait()
+
+    async def replay_events(self):
+        """
+            Replays buffered events in order they came
+
+            Replayed events go through write-behind queue,
+            which is flushed at once afterwards
+        """
+        replayed = 0
+        while len(self.event_buffer) > 0 and not self.awaiting_sync():
+            for handler, args, kwargs in self.event_buffer.drain():
+                try:
+                    await handler(self, *args, **kwargs)
+                    replayed += 1
+                except Exception as e:
+                    log.error(f'Failed to replay buffered event: {e}')
+        if replayed > 0:
+            await self.db.run_async(self.queue.flush)
+            log.info(f'Replayed {replayed} buffered events')
+        dropped = self.event_buffer.reset_dropped()
+        if dropped > 0:
+            log.warn(f'Dropped {dropped} buffered events')
+            await self.send_warning(f'{dropped} events were dropped while awaiting synchronization')
 
     async def send_error(self, msg: str):
         if self.error_channel is not None:
@@ -229,32 +315,35 @@ class Overlord(discord.Client):
 
     async def sync_users(self):
         log.info('Syncing roles')
-        self.s_roles.load(self.guild.roles)
+        await self.s_roles.load(self.guild.roles)
 
         log.info(f'Syncing users')
-        # Mark everyone absent
-        self.s_users.mark_everyone_absent()
-        # Reload
-        async for member in self.guild.fetch_members(limit=None):
+        members = []
+        for member in await self.s_members.get_all():
             # Cache and skip bots
             if member.bot:
                 self.s_users.cache_bot(member)
                 continue
-            # Update and repair
-            user = self.s_users.update_member(member)
-            self.s_events.repair_member_joined_event(member, user)
+            members.append(member)
+        # Update and repair in bulk
+        user_ids = await self.db.run_async(self.s_users.sync_members, members)
+        self.s_users.refresh_cache(members, user_ids)
+        await self.db.run_async(self.s_events.repair_member_joined_events, members, user_ids)
         # Remove effectively absent
         if not self.config["user.leave.keep"]:
-            self.s_users.remove_absent()
+            await self.s_users.remove_absent_async()
         self.unset_awaiting_sync()
         log.info(f'Syncing users done')
+        # Caller holds guild lock, replay after it is released
+        if self.initialized():
+            self.loop.create_task(self.replay_events())
 
     async def update_user_rank(self, member: discord.Member):
         if self.awaiting_sync():
             log.warn("Cannot update user rank: awaiting role sync")
             return False
         # Resolve user
-        user = self.s_users.get(member)
+        user = await self.s_users.get_async(member)
         # Skip non-existing users
         if user is None:
             log.warn(f'{qualified_name(member)} does not exist in db! Skipping user rank update!')
@@ -262,34 +351,77 @@ class Overlord(discord.Client):
         # Ignore inappropriate members
         if self.s_ranking.ignore_member(member):
             return
+        if self.__rank_sweep.locked():
+            self.__rank_touched.add(member.id)
         # Resolve roles to move
-        roles_add, roles_del = self.s_ranking.roles_to_add_and_remove(member, user)
-        # Remove old roles
-        if roles_del:
-            log.info(f"Removing {qualified_name(member)}'s rank roles: {roles_del}")
-            await member.remove_roles(*roles_del)
-        # Add new roles
-        if roles_add:
-            log.info(f"Adding {qualified_name(member)}'s rank roles: {roles_add}")
-            await member.add_roles(*roles_add)
+        roles_add, roles_del = await self.s_ranking.roles_to_add_and_remove(member, user)
+        if roles_del or roles_add:
+            log.info(f"Moving {qualified_name(member)}'s rank roles: +{roles_add} -{roles_del}")
+            await self.role_scheduler.mutate(member, roles_add, roles_del)
         # Update user in db
-        self.s_users.update_member(member)
+        await self.s_users.update_member_async(member)
         return True
 
+    async def __update_user_rank_by_did(self, did: int):
+        # Debounced rank update, runs off event handler path
+        user = await self.s_users.get_by_did_async(did)
+        if user is None or self.s_users.is_absent(user):
+            return
+        member = await self.s_members.get(did)
+        if member is None:
+            return
+        async with self.user_sync(did):
+            await self.update_user_rank(member)
+
     async def update_user_ranks(self):
+        # Sweeps don't overlap, members are locked one at a time
+        async with self.__rank_sweep:
+            try:
+                await self.__update_user_ranks()
+            finally:
+                # Plan may be stale for members updated meanwhile
+                for did in self.__rank_touched:
+                    self.rank_updates.mark(did)
+                self.__rank_touched = set()
+
+    async def __update_user_ranks(self):
         if self.awaiting_sync():
             log.error("Cannot update user ranks: awaiting role sync")
             await self.send_error(f'Cannot update user ranks: awaiting role sync')
             return
         log.info(f'Updating user ranks')
-        async for member in self.guild.fetch_members(limit=None):
-            # Cache and skip bots
-            if member.bot:
-                self.s_users.cache_bot(member)
+        users = await self.db.run_async(self.s_users.get_present_users)
+        # Stale masks are rebuilt from live member roles by debounced update
+        stale = [user.did for user in users if self.s_ranking.stale_mask(user.roles)]
+        if stale:
+            log.warn(f'Role masks of {len(stale)} users are stale, updating them separately')
+            for did in stale:
+                self.rank_updates.mark(did)
+        plan = await self.s_ranking.plan_rank_changes(users)
+        roles_add = sum(len(change.add) for change in plan)
+        roles_del = sum(len(change.remove) for change in plan)
+        log.info(f'Rank update plan: {len(plan)} members, {roles_add} roles to add, {roles_del} roles to remove')
+        await self.control_channel.send(res.get("messages.rank_plan").format(len(plan), roles_add, roles_del))
+        # Apply plan
+        changes, mutations = [], []
+        members = {member.id: member for member in await self.s_members.get_all()}
+        for change in plan:
+            member = members.get(change.did)
+            if member is None:
                 continue
-            await self.update_user_rank(member)
+            changes.append(change)
+            mutations.append((member, [self.s_roles.get(r) for r in change.add], [self.s_roles.get(r) for r in change.remove]))
+        async def report(done: int, failed: int, total: int):
+            await self.control_channel.send(res.get("messages.rank_progress").format(done, failed, total))
+        results = await self.role_scheduler.run(mutations, progress=report, progress_every=self.config["ranks.scheduler.progress_every"],
+                                                guard=lambda member: self.user_sync(member.id))
+        masks = {change.did: (change.user_id, change.roles) for change, ok in zip(changes, results) if ok}
+        await self.s_users.update_role_masks_async(masks)
         log.info(f'Done updating user ranks')
 
+    async def resolve_member(self, did: int) -> Optional[discord.Member]:
+        return await self.s_members.get(did)
+
     async def resolve_user(self, user_mention: str) -> Optional[discord.User]:
             try:
                 if '#' in user_mention:
@@ -304,10 +436,22 @@ class Overlord(discord.Client):
             except ValueError:
                 return None
 
-    async def logout(self):
+    async def close(self):
+        # Both logout() and run() shutdown end up here
+        if self.__closing:
+            return await super().close()
+        self.__closing = True
         for task in self.tasks:
             task.stop()
-        await super().logout()
+        self.rank_updates.cancel()
+        try:
+            await self.s_stats.flush_async()
+        except Exception as e:
+            log.error(f'Failed to flush stat cache on close: {e}')
+        if not await self.s_events.flush_async():
+            log.error(f'Ingest queue flush failed on close, {len(self.queue)} rows lost')
+        await super().close()
+        self.db.close()
 
     #############
     # Own tasks #
@@ -364,6 +508,7 @@ class Overlord(discord.Client):
             self.guild = self.get_guild(self.guild_id)
             if self.guild is None:
                 raise InvalidConfigException("Discord server id is invalid", "DISCORD_GUILD")
+            self.s_members.guild = self.guild
             log.info(f'{self.user} is connected to the following guild: {self.guild.name}(id: {self.guild.id})')
 
             self.me = await self.guild.fetch_member(self.user.id)
@@ -394,16 +539,24 @@ class Overlord(discord.Client):
             self.check_config()
 
             # Schedule tasks
-            self.tasks.append(self.s_stats.get_stat_update_task(self.sync(), hours=24, loop=asyncio.get_running_loop()))
+            self.tasks.append(self.s_stats.get_stat_update_task(hours=24, loop=asyncio.get_running_loop()))
             self.tasks.append(self.get_user_sync_task(minutes=1, loop=asyncio.get_running_loop()))
+            self.tasks.append(self.s_events.get_flush_task(seconds=self.config["ingest.flush_interval"], loop=asyncio.get_running_loop()))
+            self.tasks.append(self.s_stats.get_flush_task(seconds=self.config["cache.stats.flush_interval"], loop=asyncio.get_running_loop()))
 
             # Start tasks
             for task in self.tasks:
                 task.start()
             
-            # Message for pterodactyl panel
-            print(self.config["egg_done"])
-            self.__initialized = True
+        # Replay events received during initialization
+        await self.replay_events()
+        self.__ready.set()
+
+        # Index known messages in background, lookups hit db meanwhile
+        self.loop.create_task(self.s_events.warm_message_index())
+
+        # Message for pterodactyl panel
+        print(self.config["egg_done"])
 
 
     @after_initialized
@@ -421,8 +574,8 @@ class Overlord(discord.Client):
             await self.on_control_message(message)
             return
         # Sync code part
-        async with self.sync():
-            user = self.s_users.get(message.author)
+        async with self.user_sync(message.author.id, ('channel', message.channel.id)):
+            user = await self.s_users.get_async(message.author)
             # Skip non-existing users
             if user is None:
                 log.warn(f'{qualified_name(message.author)} does not exist in db! Skipping new message event!')
@@ -430,10 +583,9 @@ class Overlord(discord.Client):
             # Save event
             self.s_events.create_new_message_event(user, message)
             # Update stats
-            inc_value = self.s_stats.get(user, 'new_message_count') + 1
-            self.s_stats.set(user, 'new_message_count', inc_value)
+            self.s_stats.increment_many([(user, 'new_message_count', 1)])
             # Update user rank
-            await self.update_user_rank(message.author)
+            self.rank_updates.mark(message.author.id)
 
 
     async def on_control_message(self, message: discord.Message):
@@ -476,7 +628,9 @@ class Overlord(discord.Client):
         
         hook = get_module_element(control_hooks[cmd_name])
         check_coroutine(hook)
-        await hook(self, message, prefix, argv)
+        # Commands may query db inline, command is unit of work for those
+        with self.db.unit():
+            await hook(self, message, prefix, argv)
 
     
     @after_initialized
@@ -490,20 +644,19 @@ class Overlord(discord.Client):
         if self.is_special_channel_id(payload.channel_id):
             return
         # ingore absent
-        msg = self.s_events.get_message(payload.message_id)
+        msg = await self.s_events.get_message_async(payload.message_id)
         if msg is None:
             return
         # Sync code part
-        async with self.sync():
+        async with self.user_sync(msg.user_did, ('channel', msg.channel_id)):
+            user = await self.s_users.get_by_did_async(msg.user_did)
+            if user is None:
+                return
             self.s_events.create_message_edit_event(msg)
             # Update stats
-            inc_value = self.s_stats.get(msg.user, 'edit_message_count') + 1
-            self.s_stats.set(msg.user, 'edit_message_count', inc_value)
+            self.s_stats.increment(user, 'edit_message_count')
             # Update user rank
-            if self.s_users.is_absent(msg.user):
-                return
-            member = await self.guild.fetch_member(msg.user.did)
-            await self.update_user_rank(member)
+            self.rank_updates.mark(user.did)
 
     
     @after_initialized
@@ -517,23 +670,23 @@ class Overlord(discord.Client):
         if self.is_special_channel_id(payload.channel_id):
             return
         # ingore absent
-        msg = self.s_events.get_message(payload.message_id)
+        msg = await self.s_events.get_message_async(payload.message_id)
         if msg is None:
             return
         # Sync code part
-        async with self.sync():
+        async with self.user_sync(msg.user_did, ('channel', msg.channel_id)):
+            user = await self.s_users.get_by_did_async(msg.user_did)
+            if user is None:
+                return
             self.s_events.create_message_delete_event(msg)
             # Update stats
-            inc_value = self.s_stats.get(msg.user, 'delete_message_count') + 1
-            self.s_stats.set(msg.user, 'delete_message_count', inc_value)
+            self.s_stats.increment(user, 'delete_message_count')
             # Update user rank
-            if self.s_users.is_absent(msg.user):
-                return
-            member = await self.guild.fetch_member(msg.user.did)
-            await self.update_user_rank(member)
+            self.rank_updates.mark(user.did)
 
     
     @after_initialized
+    @after_sync
     @event_config("user.join")
     @skip_bots
     @guild_member_event
@@ -543,17 +696,17 @@ class Overlord(discord.Client):
 
             Saves user in database
         """
-        if self.awaiting_sync():
-            return
+        self.s_members.invalidate(member.id)
         # Sync code part
-        async with self.sync():
+        async with self.user_sync(member.id):
             # Add/update user
-            user = self.s_users.update_member(member)
+            user = await self.s_users.update_member_async(member)
             # Add event
             self.s_events.create_member_join_event(user, member)
 
     
     @after_initialized
+    @after_sync
     @event_config("user.update")
     @skip_bots
     @guild_member_event
@@ -563,8 +716,6 @@ class Overlord(discord.Client):
 
             Removes user from database (or keep it, depends on config)
         """
-        if self.awaiting_sync():
-            return
         # track only role/nickname change
         if not (before.roles != after.roles or \
                 before.display_name != after.display_name or \
@@ -572,13 +723,13 @@ class Overlord(discord.Client):
                 before.discriminator != after.discriminator):
             return
         # Skip absent
-        if self.s_users.get(before) is None:
+        if await self.s_users.get_async(before) is None:
             log.warn(f'{qualified_name(after)} does not exist in db! Skipping user update event!')
             return
         # Sync code part
-        async with self.sync():
+        async with self.user_sync(after.id):
             # Update user
-            self.s_users.update_member(after)
+            await self.s_users.update_member_async(after)
 
     
     @after_initialized
@@ -591,16 +742,17 @@ class Overlord(discord.Client):
 
             Removes user from database (or keep it, depends on config)
         """
+        self.s_members.invalidate(member.id)
         # Sync code part
-        async with self.sync():
+        async with self.user_sync(member.id):
             if self.config["user.leave.keep"]:
-                user = self.s_users.mark_absent(member)
+                user = await self.s_users.mark_absent_async(member)
                 if user is None:
                     log.warn(f'{qualified_name(member)} does not exist in db! Skipping user leave event!')
                     return
                 self.s_events.create_user_leave_event(user)
             else:
-                user = self.s_users.remove(member)
+                user = await self.s_users.remove_async(member)
                 if user is None:
                     log.warn(f'{qualified_name(member)} does not exist in db! Skipping user leave event!')
                     return
@@ -631,16 +783,16 @@ class Overlord(discord.Client):
             Saves event in database
         """
         # Sync code part
-        async with self.sync():
-            user = self.s_users.get(member)
+        async with self.user_sync(member.id):
+            user = await self.s_users.get_async(member)
             # Skip non-existing users
             if user is None:
                 log.warn(f'{qualified_name(member)} does not exist in db! Skipping vc join event!')
                 return
             # Apply constraints
-            self.s_events.repair_vc_leave_event(user, channel)
-            # Save event
-            self.s_events.create_vc_join_event(user, channel)
+            await self.s_events.repair_vc_session_async(user, channel)
+            # Open session
+            await self.s_events.open_vc_session(user, channel)
             
     
     @event_config("voice.leave")
@@ -651,22 +803,20 @@ class Overlord(discord.Client):
             Saves event in database
         """
         # Sync code part
-        async with self.sync():
-            user = self.s_users.get(member)
+        async with self.user_sync(member.id):
+            user = await self.s_users.get_async(member)
             # Skip non-existing users
             if user is None:
                 log.warn(f'{qualified_name(member)} does not exist in db! Skipping vc leave event!')
                 return
-            # Close event
-            join_event = self.s_events.close_vc_join_event(user, channel)
-            if join_event is None:
+            # Close session
+            duration = await self.s_events.close_vc_session(user, channel)
+            if duration is None:
                 return
             # Update stats
-            stat_val = self.s_stats.get(user, 'vc_time')
-            stat_val += (join_event.updated_at - join_event.created_at).total_seconds()
-            self.s_stats.set(user, 'vc_time', stat_val)
+            self.s_stats.increment_many([(user, 'vc_time', duration)])
             # Update user rank
-            await self.update_user_rank(member)
+            self.rank_updates.mark(member.id)
 
     async def on_guild_role_create(self, role: discord.Role):
         if self.awaiting_sync():
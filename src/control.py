@@ -28,12 +28,22 @@ log = logging.getLogger('control')
 # Utility funcs #
 #################
 
-def __build_stat_line(client: bot.Overlord, user: db.User, stat: str, formatter=lambda x:str(x)):
+def __build_stat_line(stat: str, stat_val: int, formatter=lambda x:str(x)):
     stat_name = res.get(f"messages.{stat}_stat")
-    stat_val = client.s_stats.get(user, stat)
     stat_val_f = formatter(stat_val)
     return res.get("messages.user_stats_entry").format(stat_name, stat_val_f)
 
+def __clear_table(session: db.DBSession, model: db.BaseModel):
+    session.query(model).delete()
+    session.commit()
+
+async def __reload_all_stats(client: bot.Overlord, msg: discord.Message):
+    async def progress(stat: str, seconds: float, done: int, total: int):
+        answer = res.get("messages.user_stat_reloaded")
+        await msg.channel.send(answer.format(stat, f'{seconds:.2f}', done, total))
+    timings = await client.s_stats.reload_stats_async(list(client.s_stats.user_stat_type_map), progress)
+    log.info(f'Reloaded {len(timings)} stats, {sum(timings.values()):.2f}s of work')
+
 ############################
 # Control command Handlers #
 ############################
@@ -41,12 +51,31 @@ def __build_stat_line(client: bot.Overlord, user: db.User, stat: str, formatter=
 
 @cmdcoro
 async def ping(client: bot.Overlord, msg: discord.Message):
-    if client.sync().locked():
+    if client.locks.locked():
         await msg.channel.send(res.get("messages.busy"))
     else:
         await msg.channel.send(res.get("messages.pong"))
 
 
+@cmdcoro
+async def get_db_stats(client: bot.Overlord, msg: discord.Message):
+    status = client.db.pool_status()
+    lines = [res.get("messages.db_stats_entry").format(k, status[k]) for k in status]
+    answer = res.get("messages.db_stats_head") + '\n' + '\n'.join(lines)
+    await msg.channel.send(answer)
+
+
+@cmdcoro
+async def get_cache_stats(client: bot.Overlord, msg: discord.Message):
+    caches = client.cache_stats()
+    line_fmt = res.get("messages.cache_stats_entry")
+    lines = [line_fmt.format(name, len(c), c.capacity, c.hits, c.misses, round(c.hit_ratio() * 100, 1)) for name, c in caches.items()]
+    members = client.s_members
+    lines.append(res.get("messages.cache_stats_members").format(members.gateway_hits, members.rest_calls))
+    answer = res.get("messages.cache_stats_head") + '\n' + '\n'.join(lines)
+    await msg.channel.send(answer)
+
+
 @cmdcoro
 async def sync_roles(client: bot.Overlord, msg: discord.Message):
     async with client.sync():
@@ -57,16 +86,16 @@ async def sync_roles(client: bot.Overlord, msg: discord.Message):
 
 @cmdcoro
 async def update_user_ranks(client: bot.Overlord, msg: discord.Message):
-    async with client.sync():
-        await msg.channel.send(res.get("messages.update_ranks_begin"))
-        await client.update_user_ranks()
-        await msg.channel.send(res.get("messages.done"))
+    # Members are locked per role edit, events keep flowing
+    await msg.channel.send(res.get("messages.update_ranks_begin"))
+    await client.update_user_ranks()
+    await msg.channel.send(res.get("messages.done"))
 
 
 @cmdcoro
 @member_mention_arg
 async def update_user_rank(client: bot.Overlord, msg: discord.Message, member: discord.Member):
-    async with client.sync():
+    async with client.user_sync(member.id):
         await msg.channel.send(res.get("messages.update_rank_begin").format(member.mention))
         await client.update_user_rank(member)
         await msg.channel.send(res.get("messages.done"))
@@ -82,13 +111,13 @@ async def reload_channel_history(client: bot.Overlord, msg: discord.Message, cha
         return
 
     # Tranaction begins
-    async with client.sync():
+    async with client.locks.acquire(('channel', channel.id)):
 
         # Drop full channel message history
         log.warn(f'Dropping #{channel.name}({channel.id}) history')
         answer = res.get("messages.channel_history_drop").format(channel.mention)
         await msg.channel.send(answer)
-        client.s_events.clear_text_channel_history(channel)
+        await client.s_events.clear_text_channel_history_async(channel)
 
         # Load all messages
         log.warn(f'Loading #{channel.name}({channel.id}) history')
@@ -118,19 +147,32 @@ async def reload_channel_history(client: bot.Overlord, msg: discord.Message, cha
 
 @cmdcoro
 async def recalculate_stats(client: bot.Overlord, msg: discord.Message):
+    # Stats are swapped in atomically, no global lock needed
+    log.info(f"Recalculating all stats")
+    answer = res.get("messages.user_stat_calc")
+    await msg.channel.send(answer.format('all'))
+    await __reload_all_stats(client, msg)
+
+    log.info(f'Done')
+    await msg.channel.send(res.get("messages.done"))
+
+
+@cmdcoro
+async def rebuild_rollups(client: bot.Overlord, msg: discord.Message):
     # Tranaction begins
     async with client.sync():
+        log.info(f"Rebuilding event rollups")
+        await msg.channel.send(res.get("messages.rollups_rebuild"))
+        await client.db.run_async(client.s_events.rebuild_buckets)
+
         log.info(f"Recalculating all stats")
         answer = res.get("messages.user_stat_calc")
         await msg.channel.send(answer.format('all'))
-
-        for stat_type in client.s_stats.user_stat_type_map:
-            client.s_stats.reload_stat(stat_type)
+        await __reload_all_stats(client, msg)
 
         log.info(f'Done')
         await msg.channel.send(res.get("messages.done"))
 
-
 @cmdcoro
 @member_mention_arg
 async def get_user_stats(client: bot.Overlord, msg: discord.Message, member: discord.Member):
@@ -140,37 +182,48 @@ async def get_user_stats(client: bot.Overlord, msg: discord.Message, member: dis
         await msg.channel.send(res.get("messages.unknown_user"))
         return
 
+    stats = await client.s_stats.get_many_async(user, ["membership", "new_message_count", "delete_message_count", "edit_message_count",
+                                                       "vc_time", "messages_7d", "messages_30d", "vc_time_30d",
+                                                       "min_weight", "max_weight", "exact_weight"])
+
     answer = res.get("messages.user_stats_head").format(member.mention) + '\n'
-    answer += __build_stat_line(client, user, "membership", formatter=pretty_days) + '\n'
-    answer += __build_stat_line(client, user, "new_message_count") + '\n'
-    answer += __build_stat_line(client, user, "delete_message_count") + '\n'
-    answer += __build_stat_line(client, user, "edit_message_count") + '\n'
-    answer += __build_stat_line(client, user, "vc_time", formatter=pretty_seconds) + '\n'
-
-    if client.s_stats.get(user, "min_weight") > 0:
-        answer += __build_stat_line(client, user, "min_weight") + '\n'
-    if client.s_stats.get(user, "max_weight") > 0:
-        answer += __build_stat_line(client, user, "max_weight") + '\n'
-    if client.s_stats.get(user, "exact_weight") > 0:
-        answer += __build_stat_line(client, user, "exact_weight") + '\n'
+    answer += __build_stat_line("membership", stats["membership"], formatter=pretty_days) + '\n'
+    answer += __build_stat_line("new_message_count", stats["new_message_count"]) + '\n'
+    answer += __build_stat_line("delete_message_count", stats["delete_message_count"]) + '\n'
+    answer += __build_stat_line("edit_message_count", stats["edit_message_count"]) + '\n'
+    answer += __build_stat_line("vc_time", stats["vc_time"], formatter=pretty_seconds) + '\n'
+    answer += __build_stat_line("messages_7d", stats["messages_7d"]) + '\n'
+    answer += __build_stat_line("messages_30d", stats["messages_30d"]) + '\n'
+    answer += __build_stat_line("vc_time_30d", stats["vc_time_30d"], formatter=pretty_seconds) + '\n'
+
+    if stats["min_weight"] > 0:
+        answer += __build_stat_line("min_weight", stats["min_weight"]) + '\n'
+    if stats["max_weight"] > 0:
+        answer += __build_stat_line("max_weight", stats["max_weight"]) + '\n'
+    if stats["exact_weight"] > 0:
+        answer += __build_stat_line("exact_weight", stats["exact_weight"]) + '\n'
 
     await msg.channel.send(answer)
     
 @cmdcoro
 async def clear_data(client: bot.Overlord, msg: discord.Message):
 
-    models = [db.MemberEvent, db.MessageEvent, db.VoiceChatEvent, db.UserStat, db.User, db.Role]
+    models = [db.MemberEvent, db.MessageEvent, db.VoiceChatEvent, db.VoiceSession, db.EventBucket, db.UserStat, db.UserStatStaging, db.UserStatWatermark, db.User, db.Role]
     table_data_drop = res.get("messages.table_data_drop")
 
     # Tranaction begins
     async with client.sync():
         log.warn("Clearing database")
         await client.send_warning("Clearing database")
+        await client.db.run_async(client.queue.flush)
+        client.s_stats.drop_cache()
+        client.s_users.cache.clear()
+        client.s_members.clear()
+        client.s_events.drop_message_index()
         for model in models:
             log.warn(f"Clearing table `{model.table_name()}`")
             await client.control_channel.send(table_data_drop.format(model.table_name()))
-            client.db.query(model).delete()
-            client.db.commit()
+            await client.db.run_async(__clear_table, client.db, model)
         client.set_awaiting_sync()
         log.info(f'Done')
         await client.control_channel.send(res.get("messages.done"))
@@ -254,7 +307,7 @@ async def alter_config(client: bot.Overlord, msg: discord.Message, path: str, va
 
 @cmdcoro
 async def get_ranks(client: bot.Overlord, msg: discord.Message):
-    ranks = client.config["ranks.role"]
+    ranks = client.s_ranking.get_table().as_dict()
     table_header = res.get('messages.rank_table_header')
     table = dict_fancy_table(ranks, key_name='rank')
     await msg.channel.send(f'{table_header}\n{quote_msg(table)}')
@@ -334,12 +387,13 @@ async def edit_rank(client: bot.Overlord, msg: discord.Message, role_name: str,
     if weight in ranks_weights and ranks_weights[weight] != role_name:
         await msg.channel.send(res.get("messages.rank_role_same_weight").format(ranks_weights[weight]))
         return
-    ranks[role_name] = {
+    # Keep other thresholds
+    ranks[role_name].update({
         "weight": weight,
         "membership": membership,
         "messages": messages_count,
         "vc": vc_time
-    }
+    })
     path = 'bot.ranks.role'
 
     if await __safe_alter_config(client, path, ranks):
@@ -363,7 +417,8 @@ async def get_user_stat(client: bot.Overlord, msg: discord.Message, member: disc
         return
 
     try:
-        answer = __build_stat_line(client, user, stat_name)
+        stats = await client.s_stats.get_many_async(user, [stat_name])
+        answer = __build_stat_line(stat_name, stats[stat_name])
         await msg.channel.send(answer)
     except NameError:
         await msg.channel.send(res.get("messages.error").format("Invalid stat name"))
@@ -389,6 +444,6 @@ async def set_user_stat(client: bot.Overlord, msg: discord.Message, member: disc
     try:
         client.s_stats.set(user, stat_name, value)
         await client.control_channel.send(res.get("messages.done"))
-    except NameError:
-        await msg.channel.send(res.get("messages.error").format("Invalid stat name"))
+    except NameError as e:
+        await msg.channel.send(res.get("messages.error").format(e))
         return
@@ -14,4 +14,5 @@
 __author__ = 'Mathtin'
 
 from .session import *
+from .queue import IngestQueue
 
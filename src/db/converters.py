@@ -15,7 +15,8 @@ __author__ = 'Mathtin'
 
 import discord as d
 from .models import User, MessageEvent
-from datetime import datetime
+from datetime import date, datetime
+from collections import namedtuple
 
 #
 # Roles
@@ -46,11 +47,20 @@ def role_mask(user: d.Member, role_map: dict):
 # Users
 #
 
+# Lightweight user state detached from db session
+UserRef = namedtuple('UserRef', ['id', 'did', 'name', 'disc', 'display_name', 'roles', 'created_at'])
+
+def user_ref(user: User) -> UserRef:
+    return UserRef(user.id, user.did, user.name, user.disc, user.display_name, user.roles, user.created_at)
+
+def row_user_ref(user_id: int, row: dict) -> UserRef:
+    return UserRef(user_id, *[row.get(f) for f in UserRef._fields[1:]])
+
 def user_row(user: d.User):
     return {
         'did': user.id,
         'name': user.name,
-        'disc': user.discriminator,
+        'disc': int(user.discriminator),
         'display_name': None,
         'roles': None
     }
@@ -59,19 +69,35 @@ def member_row(user: d.Member, role_map: dict):
     return {
         'did': user.id,
         'name': user.name,
-        'disc': user.discriminator,
+        'disc': int(user.discriminator),
         'display_name': user.display_name,
         'roles': role_mask(user, role_map),
         'created_at': user.joined_at
     }
 
-def member_join_row(user: User, joined: datetime ,events: dict):
+def member_join_row(user_id: int, joined: datetime ,events: dict):
     return {
         'type_id': events["member_join"],
-        'user_id': user.id,
+        'user_id': user_id,
         'created_at': joined
     }
 
+def same_timestamp(t1: datetime, t2: datetime):
+    # DB timestamps may be stored without fractional part
+    if t1 is None or t2 is None:
+        return t1 is t2
+    return t1.replace(microsecond=0) == t2.replace(microsecond=0)
+
+def is_row_changed(row, values: dict):
+    for col in values:
+        old, new = getattr(row, col), values[col]
+        if isinstance(new, datetime):
+            if not same_timestamp(old, new):
+                return True
+        elif old != new:
+            return True
+    return False
+
 def user_leave_row(user: User, events: dict):
     return {
         'type_id': events["member_leave"],
@@ -81,6 +107,12 @@ def user_leave_row(user: User, events: dict):
 # Messages
 #
 
+# Message event identity without db session
+MessageRef = namedtuple('MessageRef', ['message_id', 'channel_id', 'user_id', 'user_did'])
+
+def message_ref(user_did: int, row: dict) -> MessageRef:
+    return MessageRef(row['message_id'], row['channel_id'], row['user_id'], user_did)
+
 def new_message_to_row(user_id: int, msg: d.Message, events: dict):
     return {
         'type_id': events["new_message"],
@@ -90,18 +122,18 @@ def new_message_to_row(user_id: int, msg: d.Message, events: dict):
         'created_at': msg.created_at
     }
 
-def message_edit_row(msg: MessageEvent, events: dict):
+def message_edit_row(msg: MessageRef, events: dict):
     return {
         'type_id': events["message_edit"],
-        'user_id': msg.user.id,
+        'user_id': msg.user_id,
         'message_id': msg.message_id,
         'channel_id': msg.channel_id
     }
 
-def message_delete_row(msg: MessageEvent, events: dict):
+def message_delete_row(msg: MessageRef, events: dict):
     return {
         'type_id': events["message_delete"],
-        'user_id': msg.user.id,
+        'user_id': msg.user_id,
         'message_id': msg.message_id,
         'channel_id': msg.channel_id
     }
@@ -110,18 +142,24 @@ def message_delete_row(msg: MessageEvent, events: dict):
 # VC
 #
 
-def vc_join_row(user: User, channel: d.VoiceChannel, events: dict):
+def vc_session_row(user_id: int, channel_id: int):
     return {
-        'type_id': events["vc_join"],
-        'user_id': user.id,
-        'channel_id': channel.id
+        'user_id': user_id,
+        'channel_id': channel_id
     }
 
-def vc_leave_row(user: User, channel: d.VoiceChannel, events: dict):
+#
+# Event buckets
+#
+
+def event_bucket_row(user_id: int, type_id: int, day: date, channel_id: int, count: int = 1, seconds: int = 0):
     return {
-        'type_id': events["vc_leave"],
-        'user_id': user.id,
-        'channel_id': channel.id
+        'user_id': user_id,
+        'type_id': type_id,
+        'day': day,
+        'channel_id': channel_id,
+        'count': count,
+        'seconds': seconds
     }
 
 #
@@ -134,3 +172,10 @@ def empty_user_stat_row(user_id: int, type_id: int):
         'user_id': user_id,
         'value': 0
     }
+
+def user_stat_row(user_id: int, type_id: int, value: int):
+    return {
+        'type_id': type_id,
+        'user_id': user_id,
+        'value': value
+    }
@@ -13,10 +13,11 @@
 
 __author__ = 'Mathtin'
 
-from sqlalchemy import Column, VARCHAR, Integer, ForeignKey, Text, BigInteger
+from sqlalchemy import Column, VARCHAR, Integer, ForeignKey, Text, BigInteger, Date, TIMESTAMP
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.sql.schema import Index
+from sqlalchemy.sql.schema import Index, UniqueConstraint
+from sqlalchemy.sql.functions import now
 from .base import BaseModel
 
 class EventType(BaseModel):
@@ -85,3 +86,49 @@ class VoiceChatEvent(Event, BaseModel):
         s = super().__repr__()[:-2]
         f = ",channel_id={0.channel_id!r}".format(self)
         return s + f + ")>"
+
+class EventBucket(BaseModel):
+    __tablename__ = 'event_buckets'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'day', 'channel_id', 'type_id', name='unique_event_bucket'),
+        Index('cix_event_buckets', "type_id", "day"),
+    )
+
+    day = Column(Date, nullable=False)
+    channel_id = Column(BigInteger, nullable=False, index=True)
+    count = Column(Integer, nullable=False, default=0)
+    seconds = Column(Integer, nullable=False, default=0)
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    type_id = Column(Integer, ForeignKey('event_types.id', ondelete='CASCADE'), nullable=False)
+
+    user = relationship("User", lazy="select")
+    type = relationship("EventType", lazy="select")
+
+    def __repr__(self):
+        s = super().__repr__()[:-2]
+        f = ",user_id={0.user_id!r},type_id={0.type_id!r},day={0.day!r},channel_id={0.channel_id!r},count={0.count!r},seconds={0.seconds!r}".format(self)
+        return s + f + ")>"
+
+class VoiceSession(BaseModel):
+    __tablename__ = 'vc_sessions'
+
+    # Both ends are taken from DB clock
+    started_at = Column(TIMESTAMP, nullable=False, server_default=now())
+    ended_at = Column(TIMESTAMP, nullable=True, default=None)
+    duration = Column(Integer, nullable=False, default=0)
+    channel_id = Column(BigInteger, nullable=False)
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+
+    user = relationship("User", lazy="select")
+
+    __table_args__ = (
+        # Partial where supported, on MySQL ended_at key part narrows lookup to open rows
+        Index('pix_vc_sessions_open', "user_id", "channel_id", "ended_at", sqlite_where=ended_at.is_(None), postgresql_where=ended_at.is_(None)),
+    )
+
+    def __repr__(self):
+        s = super().__repr__()[:-2]
+        f = ",user_id={0.user_id!r},channel_id={0.channel_id!r},started_at={0.started_at!r},ended_at={0.ended_at!r},duration={0.duration!r}".format(self)
+        return s + f + ")>"
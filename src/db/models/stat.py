@@ -14,7 +14,7 @@
 __author__ = 'Mathtin'
 
 from enum import unique
-from sqlalchemy import Column, VARCHAR, ForeignKey, Integer, Text
+from sqlalchemy import Column, VARCHAR, ForeignKey, Integer, Text, TIMESTAMP
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import UniqueConstraint
 from .base import BaseModel
@@ -48,3 +48,33 @@ class UserStat(BaseModel):
         s = super().__repr__()[:-2]
         f = "user_id={0.user_id!r},type_id={0.type_id!r},value={0.value!r}".format(self)
         return s + f + ")>"
+
+class UserStatStaging(BaseModel):
+    __tablename__ = 'user_stats_staging'
+
+    value = Column(Integer, nullable=False)
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    type_id = Column(Integer, ForeignKey('user_stat_types.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    def __repr__(self):
+        s = super().__repr__()[:-2]
+        f = "user_id={0.user_id!r},type_id={0.type_id!r},value={0.value!r}".format(self)
+        return s + f + ")>"
+
+class UserStatWatermark(BaseModel):
+    __tablename__ = 'user_stat_watermarks'
+
+    # Buckets updated before watermark are folded into stat,
+    # generation is bumped (and watermark reset) whenever buckets are deleted
+    watermark = Column(TIMESTAMP, nullable=True, default=None)
+    generation = Column(Integer, nullable=False, default=0)
+
+    type_id = Column(Integer, ForeignKey('user_stat_types.id', ondelete='CASCADE'), nullable=False, unique=True)
+
+    type = relationship("UserStatType", lazy="select")
+
+    def __repr__(self):
+        s = super().__repr__()[:-2]
+        f = "type_id={0.type_id!r},watermark={0.watermark!r},generation={0.generation!r}".format(self)
+        return s + f + ")>"
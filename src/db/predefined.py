@@ -31,5 +31,8 @@ USER_STAT_TYPES = [
     { 'name': 'membership', 'description': 'days user being member of discord server' },
     { 'name': 'min_weight', 'description': 'minimal weith (rank) applicable to user' },
     { 'name': 'max_weight', 'description': 'maximal weith (rank) applicable to user' },
-    { 'name': 'exact_weight', 'description': 'exact weith (rank) applicable to user' }
+    { 'name': 'exact_weight', 'description': 'exact weith (rank) applicable to user' },
+    { 'name': 'messages_7d', 'description': 'message sent count per user for last 7 days' },
+    { 'name': 'messages_30d', 'description': 'message sent count per user for last 30 days' },
+    { 'name': 'vc_time_30d', 'description': 'time spent in voice chat per user for last 30 days in seconds' }
 ]
@@ -13,14 +13,15 @@
 
 __author__ = 'Mathtin'
 
-from datetime import datetime
+from datetime import date, datetime
+from typing import Dict
 from sqlalchemy.orm.query import Query
 from sqlalchemy.sql.dml import Insert, Update
 from sqlalchemy.sql.elements import literal_column
 from sqlalchemy.sql.selectable import Select
 from sqlalchemy.sql.expression import cast
 from sqlalchemy.sql.sqltypes import Integer
-from sqlalchemy import func, insert, select, update, and_
+from sqlalchemy import func, insert, select, update, and_, case
 
 from .models import *
 from .session import DBSession
@@ -47,6 +48,17 @@ def get_user_by_did(db: DBSession, id: int) -> User:
 def get_msg_by_did(db: DBSession, id: int) -> MessageEvent:
     return db.query(MessageEvent).filter(MessageEvent.message_id == id).first()
 
+def get_msg_ref_by_did(db: DBSession, id: int) -> tuple:
+    return db.query(MessageEvent.message_id, MessageEvent.channel_id, MessageEvent.user_id, User.did)\
+            .join(User)\
+            .filter(MessageEvent.message_id == id).first()
+
+def get_new_msg_refs(db: DBSession, type_id: int, after_id: int, limit: int) -> list:
+    return db.query(MessageEvent.id, MessageEvent.message_id, MessageEvent.channel_id, MessageEvent.user_id, User.did)\
+            .join(User)\
+            .filter(MessageEvent.type_id == type_id, MessageEvent.id > after_id)\
+            .order_by(MessageEvent.id).limit(limit).all()
+
 def get_last_member_event_by_did(db: DBSession, id: int) -> MessageEvent:
     return db.query(MemberEvent).join(User)\
             .filter(User.did == id)\
@@ -57,40 +69,96 @@ def get_last_member_event_by_id(db: DBSession, id: int) -> MessageEvent:
             .filter(MemberEvent.user_id == id)\
             .order_by(MemberEvent.created_at.desc()).first()
 
-def get_last_vc_event_by_id(db: DBSession, id: int, channel_id: int) -> VoiceChatEvent:
-    return db.query(VoiceChatEvent)\
-            .filter(and_(VoiceChatEvent.user_id == id, VoiceChatEvent.channel_id == channel_id))\
-            .order_by(VoiceChatEvent.created_at.desc()).first()
+def get_last_member_events(db: DBSession) -> Query:
+    last = db.query(MemberEvent.user_id, func.max(MemberEvent.created_at).label('created_at'))\
+            .group_by(MemberEvent.user_id).subquery()
+    return db.query(MemberEvent.id, MemberEvent.user_id, MemberEvent.type_id, MemberEvent.created_at)\
+            .join(last, and_(MemberEvent.user_id == last.c.user_id, MemberEvent.created_at == last.c.created_at))
+
+def get_open_vc_session(db: DBSession, id: int, channel_id: int) -> VoiceSession:
+    return db.query(VoiceSession)\
+            .filter(and_(VoiceSession.user_id == id, VoiceSession.channel_id == channel_id, VoiceSession.ended_at == None)).first()
 
 def get_user_stat_by_id(db: DBSession, id: int, type_id: int) -> UserStat:
     return db.query(UserStat)\
             .filter(and_(UserStat.user_id == id, UserStat.type_id == type_id)).first()
 
-def select_membership_time_per_user(type_id: int, lit_values: list) -> Select:
-    join_time = date_to_secs(func.max(MemberEvent.created_at))
-    current_time = int(datetime.now().timestamp())
-    membership_value = cast((current_time - join_time) / 86400, Integer).label('value')
-    lit_columns = [literal_column(str(v)).label(l) for (l,v) in lit_values]
-    select_columns = [membership_value, MemberEvent.user_id] + lit_columns
-    return select(select_columns).where(and_(MemberEvent.type_id == type_id, User.roles != None)).group_by(MemberEvent.user_id)
+def select_user_stats_pivot(type_ids: Dict[str, int], user_id: int = None) -> Select:
+    value_columns = [func.sum(case([(UserStat.type_id == t, UserStat.value)], else_=0)).label(n) for n, t in type_ids.items()]
+    select_columns = [UserStat.user_id] + value_columns
+    query = select(select_columns).where(UserStat.type_id.in_(list(type_ids.values())))
+    if user_id is not None:
+        query = query.where(UserStat.user_id == user_id)
+    return query.group_by(UserStat.user_id)
 
-def select_message_count_per_user(type_id: int, lit_values: list) -> Select:
-    value_column = func.count(MessageEvent.id).label('value')
+def select_bucket_sum_per_user(type_id: int, lit_values: list, column: str, touched_since: datetime = None) -> Select:
+    value_column = func.sum(getattr(EventBucket, column)).label('value')
     lit_columns = [literal_column(str(v)).label(l) for (l,v) in lit_values]
-    select_columns = [value_column, MessageEvent.user_id] + lit_columns
-    return select(select_columns).where(MessageEvent.type_id == type_id).group_by(MessageEvent.user_id)
-
-def select_vc_time_per_user(type_id: int, lit_values: list) -> Select:
+    select_columns = [value_column, EventBucket.user_id] + lit_columns
+    query = select(select_columns).where(EventBucket.type_id == type_id)
+    if touched_since is not None:
+        # Only users having buckets updated since given time
+        touched = select([EventBucket.user_id]).where(and_(EventBucket.type_id == type_id, EventBucket.updated_at >= touched_since))
+        query = query.where(EventBucket.user_id.in_(touched))
+    return query.group_by(EventBucket.user_id)
+
+def select_bucket_window_sums(windows: Dict[str, tuple], user_id: int = None) -> Select:
+    # windows: name -> (type_id, column, since)
+    value_columns = [func.sum(case([(and_(EventBucket.type_id == t, EventBucket.day >= s), getattr(EventBucket, c))], else_=0)).label(n)
+                     for n, (t, c, s) in windows.items()]
+    select_columns = [EventBucket.user_id] + value_columns
+    since = min(s for _, _, s in windows.values())
+    query = select(select_columns).where(and_(EventBucket.type_id.in_([t for t, _, _ in windows.values()]), EventBucket.day >= since))
+    if user_id is not None:
+        query = query.where(EventBucket.user_id == user_id)
+    return query.group_by(EventBucket.user_id)
+
+def select_message_buckets() -> Select:
+    day = func.date(MessageEvent.created_at)
+    select_columns = [MessageEvent.user_id, day.label('day'), MessageEvent.channel_id, MessageEvent.type_id,
+                      func.count(MessageEvent.id).label('count'), literal_column('0').label('seconds')]
+    return select(select_columns).group_by(MessageEvent.user_id, day, MessageEvent.channel_id, MessageEvent.type_id)
+
+def select_vc_buckets(type_id: int) -> Select:
+    # Session time goes to bucket of the day it ends
+    day = func.date(VoiceSession.ended_at)
+    select_columns = [VoiceSession.user_id, day.label('day'), VoiceSession.channel_id, literal_column(str(type_id)).label('type_id'),
+                      func.count(VoiceSession.id).label('count'), func.sum(VoiceSession.duration).label('seconds')]
+    return select(select_columns).where(VoiceSession.ended_at != None)\
+            .group_by(VoiceSession.user_id, day, VoiceSession.channel_id)
+
+def insert_vc_sessions_from_events(type_id: int) -> Insert:
+    # Each join row holds whole session, updated_at is set on leave
     join_time = date_to_secs(VoiceChatEvent.created_at)
     left_time = date_to_secs(VoiceChatEvent.updated_at)
-    value_column = func.sum(left_time - join_time).label('value')
-    lit_columns = [literal_column(str(v)).label(l) for (l,v) in lit_values]
-    select_columns = [value_column, VoiceChatEvent.user_id] + lit_columns
-    return select(select_columns).where(VoiceChatEvent.type_id == type_id).group_by(VoiceChatEvent.user_id)
+    select_columns = [VoiceChatEvent.user_id, VoiceChatEvent.channel_id, VoiceChatEvent.created_at,
+                      VoiceChatEvent.updated_at, (left_time - join_time).label('duration')]
+    select_query = select(select_columns).where(VoiceChatEvent.type_id == type_id)
+    return insert(VoiceSession, inline=True).from_select(['user_id', 'channel_id', 'started_at', 'ended_at', 'duration'], select_query)
+
+def insert_event_buckets_from_select(select_query: Select) -> Insert:
+    return insert(EventBucket, inline=True).from_select(['user_id', 'day', 'channel_id', 'type_id', 'count', 'seconds'], select_query)
+
+def select_staged_user_ids(type_id: int) -> Select:
+    return select([UserStatStaging.user_id]).where(UserStatStaging.type_id == type_id)
+
+def select_now() -> Select:
+    return select([func.now()])
+
+def update_stat_watermark(type_id: int, generation: int, watermark: datetime) -> Update:
+    # No-op if buckets were deleted after generation was read
+    return update(UserStatWatermark).where(and_(UserStatWatermark.type_id == type_id, UserStatWatermark.generation == generation)) \
+                                    .values(watermark=watermark)
+
+def reset_stat_watermarks() -> Update:
+    return update(UserStatWatermark).values(watermark=None, generation=UserStatWatermark.generation + 1)
+
+def select_staged_user_stats(type_id: int) -> Select:
+    select_columns = [UserStatStaging.value, UserStatStaging.user_id, UserStatStaging.type_id]
+    return select(select_columns).where(UserStatStaging.type_id == type_id)
 
 def insert_user_stat_from_select(select_query: Query) -> Insert:
     return insert(UserStat, inline=True).from_select(['value', 'user_id', 'type_id'], select_query)
 
-def update_inc_user_member_stat(stat_id: int) -> Update:
-    return update(UserStat).values(value=UserStat.value + 1)\
-        .where(UserStat.type_id == stat_id)
\ No newline at end of file
+def insert_user_stat_staging_from_select(select_query: Query) -> Insert:
+    return insert(UserStatStaging, inline=True).from_select(['value', 'user_id', 'type_id'], select_query)
\ No newline at end of file
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+import threading
+
+from logging import getLogger
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from db.models.base import BaseModel
+from .session import DBSession
+
+log = getLogger('db-queue')
+
+
+class IngestQueue(object):
+    """
+        Bounded write-behind queue for insert-only rows
+
+        Rows are grouped by model and inserted in batches on flush.
+        Once `batch_size` rows are pending `on_full` is called, so owner
+        can flush ahead of schedule. Counter rows are merged by key in
+        memory and upserted with increment on flush. Counter rows
+        matching a hold are kept aside until it is released. Rows beyond
+        `capacity` are dropped. Flush may run in DB thread, so queue
+        access is guarded
+    """
+
+    __mutex: threading.RLock
+    __flush_mutex: threading.Lock
+    __pending: Dict[type, List[dict]]
+    __counters: Dict[Tuple[type, tuple, tuple], Dict[tuple, dict]]
+    __inflight: Dict[type, int]
+    __size: int
+
+    # Held counters: (model, column) -> value -> hold count
+    __holds: Dict[Tuple[type, str], Dict[object, int]]
+    __held: Dict[Tuple[type, tuple, tuple], Dict[tuple, dict]]
+    __held_size: int
+
+    # Members passed via constructor
+    db:         DBSession
+    capacity:   int
+    batch_size: int
+
+    # Called (maybe from DB thread) when batch is full
+    on_full:    Callable[[], None]
+
+    def __init__(self, db: DBSession, capacity: int = 10000, batch_size: int = 500):
+        self.db = db
+        self.capacity = max(capacity, batch_size)
+        self.batch_size = batch_size
+        self.__mutex = threading.RLock()
+        self.__flush_mutex = threading.Lock()
+        self.__pending = {}
+        self.__counters = {}
+        self.__inflight = {}
+        self.__size = 0
+        self.__holds = {}
+        self.__held = {}
+        self.__held_size = 0
+        self.__overflowing = False
+        self.dropped = 0
+        self.on_full = None
+
+    def __len__(self):
+        return self.__size + self.__held_size
+
+    def pending(self, model: BaseModel) -> int:
+        # Rows being written count too, flush waits for them
+        with self.__mutex:
+            counters = sum(len(rows) for (m, _, _), rows in self.__counters.items() if m is model)
+            return len(self.__pending.get(model, [])) + counters + self.__inflight.get(model, 0)
+
+    def put(self, model: BaseModel, row: dict):
+        with self.__mutex:
+            rows = self.__pending.setdefault(model, [])
+            rows.append(row)
+            self.__size += 1
+            if len(self) > self.capacity:
+                # Drop oldest row of same model
+                del rows[0]
+                self.__size -= 1
+                self.__overflow(model, 1)
+            full = self.__size >= self.batch_size
+        if full:
+            self.__notify_full()
+
+    def accumulate(self, model: BaseModel, keys: List[str], row: dict, increment: List[str]):
+        """
+            Queues counter row, `increment` columns are summed
+            with pending and stored rows having same `keys` values
+        """
+        with self.__mutex:
+            group = (model, tuple(keys), tuple(increment))
+            held = self.__is_held(model, row)
+            counters = (self.__held if held else self.__counters).setdefault(group, {})
+            key = tuple(row[k] for k in keys)
+            if key in counters:
+                for col in increment:
+                    counters[key][col] += row[col]
+                return
+            if len(self) >= self.capacity:
+                self.__overflow(model, 1)
+                return
+            counters[key] = dict(row)
+            if held:
+                self.__held_size += 1
+                return
+            self.__size += 1
+            full = self.__size >= self.batch_size
+        if full:
+            self.__notify_full()
+
+    def __is_held(self, model: BaseModel, row: dict) -> bool:
+        for (held_model, column), values in self.__holds.items():
+            if held_model is model and row.get(column) in values:
+                return True
+        return False
+
+    def hold(self, model: BaseModel, column: str, values: list):
+        """
+            Keeps counter rows of `model` with `column` value in `values`
+            out of flushes until released. Holds are counted
+        """
+        with self.__mutex:
+            holds = self.__holds.setdefault((model, column), {})
+            for value in values:
+                holds[value] = holds.get(value, 0) + 1
+
+    def release(self, model: BaseModel, column: str, values: list):
+        """
+            Releases hold, rows kept aside are merged back into queue
+        """
+        with self.__mutex:
+            holds = self.__holds.get((model, column), {})
+            for value in values:
+                holds[value] -= 1
+                if holds[value] == 0:
+                    del holds[value]
+            released = {}
+            for group, rows in self.__held.items():
+                for key, row in list(rows.items()):
+                    if not self.__is_held(group[0], row):
+                        released.setdefault(group, {})[key] = rows.pop(key)
+                        self.__held_size -= 1
+            self.__held = {group: rows for group, rows in self.__held.items() if rows}
+            self.__restore_counters(released)
+            full = self.__size >= self.batch_size
+        if full:
+            self.__notify_full()
+
+    @contextmanager
+    def frozen(self):
+        """
+            Blocks flushes, so db reads made inside are consistent
+            with rows left in queue
+        """
+        with self.__flush_mutex:
+            yield self
+
+    def collect(self, model: BaseModel, match: Callable[[dict], bool], take: bool = False) -> List[dict]:
+        """
+            Returns copies of pending counter rows of `model` matching
+            `match`, removing them from queue if `take` is set. Held rows
+            are returned too but never taken
+        """
+        with self.__mutex:
+            found = []
+            for (counter_model, _, _), rows in self.__counters.items():
+                if counter_model is not model:
+                    continue
+                for key, row in list(rows.items()):
+                    if match(row):
+                        found.append(dict(row))
+                        if take:
+                            del rows[key]
+                            self.__size -= 1
+            self.__counters = {group: rows for group, rows in self.__counters.items() if rows}
+            for (counter_model, _, _), rows in self.__held.items():
+                if counter_model is model:
+                    found += [dict(row) for row in rows.values() if match(row)]
+            return found
+
+    def __notify_full(self):
+        if self.on_full is not None:
+            self.on_full()
+
+    def __overflow(self, model: BaseModel, count: int):
+        self.dropped += count
+        # Warn once until next successful flush
+        if not self.__overflowing:
+            self.__overflowing = True
+            log.warn(f'Ingest queue is full, dropping `{model.table_name()}` rows')
+
+    def flush(self) -> int:
+        # Flushes are serialized, so flush returns after rows queued
+        # before it are committed. Buffers are locked only for swap
+        with self.__flush_mutex:
+            with self.__mutex:
+                if self.__size == 0:
+                    return 0
+                batches, counters, size = self.__pending, self.__counters, self.__size
+                self.__pending, self.__counters, self.__size = {}, {}, 0
+                self.__inflight = {model: len(rows) for model, rows in batches.items()}
+                for (model, _, _), rows in counters.items():
+                    self.__inflight[model] = self.__inflight.get(model, 0) + len(rows)
+            try:
+                for model in batches:
+                    self.db.add_bulk(model, batches[model])
+                for (model, keys, increment), rows in counters.items():
+                    self.db.upsert(model, list(keys), list(rows.values()), increment=list(increment))
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                with self.__mutex:
+                    self.__restore_counters(counters)
+                    self.__restore(batches, size - sum(len(rows) for rows in counters.values()))
+                raise
+            finally:
+                with self.__mutex:
+                    self.__inflight = {}
+            self.__overflowing = False
+            return size
+
+    def __restore_counters(self, counters: Dict[Tuple[type, tuple, tuple], Dict[tuple, dict]]):
+        # Failed counters are merged with ones queued meanwhile
+        for group, rows in counters.items():
+            pending = self.__counters.setdefault(group, {})
+            for key, row in rows.items():
+                if key in pending:
+                    for col in group[2]:
+                        row[col] += pending[key][col]
+                else:
+                    self.__size += 1
+                pending[key] = row
+
+    def __restore(self, batches: Dict[type, List[dict]], size: int):
+        # Failed rows go back in front of rows queued meanwhile
+        for model in self.__pending:
+            batches.setdefault(model, []).extend(self.__pending[model])
+        size += self.__size
+        # Drop oldest rows beyond capacity
+        for model in batches:
+            if size <= self.capacity:
+                break
+            overflow = min(size - self.capacity, len(batches[model]))
+            del batches[model][:overflow]
+            size -= overflow
+            self.dropped += overflow
+            log.warn(f'Ingest queue overflow, dropped {overflow} `{model.table_name()}` rows')
+        self.__pending, self.__size = batches, size
@@ -14,53 +14,188 @@
 __author__ = 'Mathtin'
 
 import os
+import asyncio
+import threading
 
 from logging import getLogger
-from datetime import datetime
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
 
-from sqlalchemy import create_engine, update
+from sqlalchemy import create_engine, update, func
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import IntegrityError, DataError
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.event import listens_for as event_listens_for
 
 from db.models.base import Base, BaseModel
 from db.models import *
+from .pool import TimedQueuePool
 
 log = getLogger('db')  
 
+Scope = Union[asyncio.Task, int]
+
+# Default host parameter limit for SQLite < 3.32
+SQLITE_MAX_VARIABLES = 999
+
 
 class DBSession(object):
 
-    __session: Session
+    # ORM sessions per scope: asyncio task on loop thread, thread id otherwise
+    __mutex: threading.Lock
+    __sessions: Dict[Scope, Session]
+    __units: Dict[Scope, int]
+    __executor: ThreadPoolExecutor
+    __workers: ThreadPoolExecutor
 
     # Main DB Connection Ref Obj
     db_engine = None
     session_factory = None
 
-    def __init__(self, engine_url, autocommit=True, autoflush=True):
+    def __init__(self, engine_url, autocommit=True, autoflush=True, async_mode=False, parallelism=4,
+                 pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=3600, pool_pre_ping=True):
         self.engine_url = engine_url
         log.info(f'Connecting to database')
-        self.db_engine = create_engine(self.engine_url, pool_recycle=60)
+        engine_kwargs = { 'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping }
+        # SQLite pools are not sized and writes are serialized anyway
+        if make_url(self.engine_url).get_backend_name() != 'sqlite':
+            engine_kwargs.update(poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+        else:
+            parallelism = 1
+        self.db_engine = create_engine(self.engine_url, **engine_kwargs)
         Base.metadata.create_all(self.db_engine)
         self.session_factory = sessionmaker(bind=self.db_engine, autocommit=autocommit, autoflush=autoflush)
-        self.__last_connection = None
-        self.__session = None
-        self.__check_connection()
-
-    def __check_connection(self):
-        now = datetime.now()
-        if self.__last_connection is None or (now - self.__last_connection).total_seconds() > 10:
-            if self.__session is not None:
-                self.__session.close()
-            self.__session = self.session_factory()
-            self.__last_connection = now
+        self.__mutex = threading.Lock()
+        self.__sessions = {}
+        self.__units = {}
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db') if async_mode else None
+        self.__workers = ThreadPoolExecutor(max_workers=max(parallelism, 1), thread_name_prefix='db-worker') if async_mode else None
+
+    @staticmethod
+    def __scope() -> Scope:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return task if task is not None else threading.get_ident()
+
+    @property
+    def __session(self) -> Session:
+        scope = DBSession.__scope()
+        with self.__mutex:
+            session = self.__sessions.get(scope)
+            if session is None:
+                session = self.session_factory()
+                self.__sessions[scope] = session
+                # Handler session lives as long as its task
+                if isinstance(scope, asyncio.Task):
+                    scope.add_done_callback(self.__release)
+        return session
+
+    def __release(self, scope: Scope):
+        with self.__mutex:
+            session = self.__sessions.pop(scope, None)
+        if session is not None:
+            session.close()
+
+    @contextmanager
+    def unit(self):
+        """
+            Unit of work for current task (or thread)
+
+            Commits on success, rolls back on error and releases
+            session connection back to pool. Nested units are merged
+        """
+        scope = DBSession.__scope()
+        self.__units[scope] = self.__units.get(scope, 0) + 1
+        try:
+            yield self
+            if self.__units[scope] == 1:
+                self.commit()
+        except Exception:
+            if self.__units[scope] == 1:
+                self.rollback()
+            raise
+        finally:
+            self.__units[scope] -= 1
+            if self.__units[scope] == 0:
+                del self.__units[scope]
+                self.__release(scope)
+
+    def pool_status(self) -> dict:
+        pool = self.db_engine.pool
+        status = { 'pool': pool.status() }
+        if isinstance(pool, TimedQueuePool):
+            status.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow(),
+                'checkouts': pool.stats.checkouts,
+                'timeouts': pool.stats.timeouts,
+                'avg_wait_ms': round(pool.stats.avg_wait() * 1000, 3),
+                'max_wait_ms': round(pool.stats.max_wait * 1000, 3)
+            })
+        return status
+
+    def is_async(self) -> bool:
+        return self.__executor is not None
+
+    async def run_async(self, func, *args, **kwargs):
+        """
+            Runs func in DB thread (or inline if async mode is off)
+            as unit of work, so each call commits or rolls back on its own
+
+            Note: ORM objects loaded inside are bound to DB thread session,
+            so return plain values out of func
+        """
+        def work():
+            with self.unit():
+                return func(*args, **kwargs)
+        if self.__executor is None:
+            return work()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, work)
+
+    def parallelism(self) -> int:
+        return self.__workers._max_workers if self.__workers is not None else 1
+
+    async def run_worker(self, func, *args, **kwargs):
+        """
+            Runs func in one of worker threads as unit of work
+
+            Each worker thread uses own session (and pooled connection),
+            so independent jobs may run concurrently
+        """
+        def work():
+            with self.unit():
+                return func(*args, **kwargs)
+        if self.__workers is None:
+            return work()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__workers, work)
+
+    async def query_async(self, *entities, fetch=lambda q: q.all(), **kwargs):
+        return await self.run_async(lambda: fetch(self.query(*entities, **kwargs)))
+
+    async def execute_async(self, *entities, **kwargs):
+        def _execute():
+            res = self.execute(*entities, **kwargs)
+            return res.fetchall() if getattr(res, 'returns_rows', True) else res.rowcount
+        return await self.run_async(_execute)
+
+    async def commit_async(self):
+        await self.run_async(self.commit)
+
+    async def sync_table_async(self, model: BaseModel, pk: str, values: list):
+        await self.run_async(self.sync_table, model, pk, values)
 
     def query(self, *entities, **kwargs):
-        self.__check_connection()
         return self.__session.query(*entities, **kwargs)
 
     def execute(self, *entities, **kwargs):
-        self.__check_connection()
         return self.__session.execute(*entities, **kwargs)
 
     def add(self, model: BaseModel, value: dict, need_flush: bool = False):
@@ -69,15 +204,22 @@ class DBSession(object):
         return row
 
     def add_model(self, model: BaseModel, need_flush: bool = False):
-        self.__check_connection()
         self.__session.add(model)
         if need_flush:
             self.__session.flush([model])
 
     def add_all(self, models: list):
-        self.__check_connection()
         self.__session.add_all(models)
 
+    def add_bulk(self, model: BaseModel, values: list):
+        self.__session.bulk_insert_mappings(model, values)
+
+    def update_bulk(self, model: BaseModel, values: list):
+        self.__session.bulk_update_mappings(model, values)
+
+    def flush(self):
+        self.__session.flush()
+
     def delete(self, model: BaseModel, pk: str, value: dict):
         row = self.query(model).filter_by(**{pk:value[pk]}).first()
         if row is None:
@@ -86,7 +228,6 @@ class DBSession(object):
         return row
 
     def delete_model(self, model: BaseModel):
-        self.__check_connection()
         try:
             self.__session.delete(model)
         except IntegrityError as e:
@@ -95,7 +236,6 @@ class DBSession(object):
             log.error(f'`{__name__}` {e}')
 
     def commit(self, need_close: bool = False):
-        self.__check_connection()
         try:
             self.__session.commit()
         except IntegrityError as e:
@@ -106,30 +246,71 @@ class DBSession(object):
             raise
 
         if need_close:
-            self.close_session()
+            self.__release(DBSession.__scope())
+
+    def rollback(self):
+        self.__session.rollback()
 
     def sync_table(self, model: BaseModel, pk: str, values: list):
-        self.__check_connection()
-        index = {}
-        for v in values:
-            index[v[pk]] = v
-
-        for row in self.query(model):
-            p = getattr(row, pk)
-            if p not in index:
-                self.delete_model(row)
-                continue
-            new_values = index[p]
-            for col in new_values:
-                if getattr(row, col) != new_values[col]:
-                    setattr(row, col, new_values[col])
-            del index[p]
+        # Drop stale rows first, so unique columns of kept rows can shift freely
+        keys = [v[pk] for v in values]
+        self.query(model).filter(getattr(model, pk).notin_(keys)).delete(synchronize_session=False)
+        self.upsert(model, pk, values)
         self.commit()
 
-        for id in index:
-            new_values = index[id]
-            self.add(model, new_values)
-        self.commit()
+    def upsert(self, model: BaseModel, keys: Union[str, List[str]], values: list, chunk_size: int = 1000, increment: List[str] = ()) -> int:
+        """
+            Inserts rows or updates existing ones matched by unique keys
+
+            Uses dialect-native upsert statement, one per chunk. All rows
+            should have same set of columns. Columns listed in `increment`
+            are added to existing values atomically. Does not commit
+        """
+        if not values:
+            return 0
+        keys = [keys] if isinstance(keys, str) else keys
+        columns = list(values[0].keys())
+        update_columns = [c for c in columns if c not in keys]
+        dialect = self.db_engine.dialect.name
+        if dialect not in (mysql.dialect.name, sqlite.dialect.name):
+            for value in values:
+                self.__update_or_add_by_keys(model, keys, value, increment)
+            self.__session.flush()
+            return len(values)
+        if dialect == sqlite.dialect.name:
+            chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // len(columns)))
+        for i in range(0, len(values), chunk_size):
+            stmt = self.__upsert_stmt(model.__table__, keys, update_columns, increment, values[i:i+chunk_size])
+            self.execute(stmt)
+        return len(values)
+
+    def __update_or_add_by_keys(self, model: BaseModel, keys: List[str], value: dict, increment: List[str]):
+        row = self.query(model).filter_by(**{k:value[k] for k in keys}).first()
+        if row is None:
+            return self.add(model, value)
+        for col in value:
+            new_value = getattr(row, col) + value[col] if col in increment else value[col]
+            if getattr(row, col) != new_value:
+                setattr(row, col, new_value)
+        return row
+
+    def __upsert_stmt(self, table, keys: List[str], update_columns: List[str], increment: List[str], values: list):
+        if self.db_engine.dialect.name == mysql.dialect.name:
+            stmt = mysql.insert(table).values(values)
+            new_row = stmt.inserted
+        else:
+            stmt = sqlite.insert(table).values(values)
+            new_row = stmt.excluded
+        new_values = { c: (table.c[c] + new_row[c] if c in increment else new_row[c]) for c in update_columns }
+        # Core statements skip onupdate hooks
+        if new_values and 'updated_at' in table.c and 'updated_at' not in new_values:
+            new_values['updated_at'] = func.now()
+        if self.db_engine.dialect.name == mysql.dialect.name:
+            # MySQL has no DO NOTHING, self-assign key instead
+            return stmt.on_duplicate_key_update(new_values or { keys[0]: stmt.inserted[keys[0]] })
+        if not new_values:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(index_elements=keys, set_=new_values)
 
     def update_or_add(self, model: BaseModel, pk: str, value: dict):
         res = self.update(model, pk, value)
@@ -138,7 +319,6 @@ class DBSession(object):
         return res
 
     def update(self, model: BaseModel, pk: str, value: dict):
-        self.__check_connection()
         row = self.query(model).filter_by(**{pk:value[pk]}).first()
         if row is None:
             return None
@@ -148,16 +328,22 @@ class DBSession(object):
         return row
 
     def touch(self, model: BaseModel, id: int):
-        self.__check_connection()
         stmt = update(model).where(model.id == id)
         self.execute(stmt)
 
     def close(self):
-        try:
-            self.__session.close()
-        except IntegrityError as e:
-            log.error(f'`{__name__}` {e}')
-            raise
-        except DataError as e:
-            log.error(f'`{__name__}` {e}')
-            raise
+        if self.__workers is not None:
+            self.__workers.shutdown(wait=True)
+        if self.__executor is not None:
+            self.__executor.submit(lambda: self.__release(threading.get_ident()))
+            self.__executor.shutdown(wait=True)
+        with self.__mutex:
+            sessions, self.__sessions = self.__sessions, {}
+        for session in sessions.values():
+            try:
+                session.close()
+            except IntegrityError as e:
+                log.error(f'`{__name__}` {e}')
+            except DataError as e:
+                log.error(f'`{__name__}` {e}')
+        self.db_engine.dispose()
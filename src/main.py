@@ -47,7 +47,10 @@ def main(argv):
     if 'sqlite' in url:
         import db.queries as q
         q.MODE = q.MODE_SQLITE
-    session = DBSession(url, autocommit=False)
+    pool = config["db.pool"]
+    session = DBSession(url, autocommit=False, async_mode=config["db.async"], parallelism=config["db.parallelism"],
+                        pool_size=pool["size"], max_overflow=pool["overflow"], pool_timeout=pool["timeout"],
+                        pool_recycle=pool["recycle"], pool_pre_ping=pool["pre_ping"])
     session.sync_table(EventType, 'name', EVENT_TYPES)
     session.sync_table(UserStatType, 'name', USER_STAT_TYPES)
 
@@ -15,6 +15,11 @@ __author__ = 'Mathtin'
 
 import asyncio
 import logging
+import time
+import numpy as np
+
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 
 import discord
 from discord.ext import tasks
@@ -23,7 +28,7 @@ import db.queries as q
 import db.converters as conv
 
 from util import *
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 ############
 # Services #
@@ -42,18 +47,89 @@ class RoleService(object):
     def __init__(self, db: DB.DBSession):
         self.db = db
 
-    def load(self, roles: List[discord.Role]):
+    async def load(self, roles: List[discord.Role]):
         self.role_map = { role.name: role for role in roles }
         roles = conv.roles_to_rows(roles)
         self.role_rows_did_map = { role['did']: role for role in roles }
         # Sync table
-        self.db.sync_table(DB.Role, 'did', roles)
+        await self.db.sync_table_async(DB.Role, 'did', roles)
 
     def get(self, role_name: str) -> discord.Role:
         if role_name in self.role_map:
             return self.role_map[role_name]
         return None
 
+class MemberService(object):
+    """
+        Resolves guild members by discord id
+
+        Gateway cache is used first, REST results
+        (including missing members) are cached for `ttl` seconds
+    """
+
+    log = logging.getLogger('member-service')
+
+    # Set on ready
+    guild:          discord.Guild
+
+    # Discord id -> (member or None, fetch time)
+    cache:          LRUCache
+    ttl:            int
+
+    # Lookup counters
+    gateway_hits:   int
+    rest_calls:     int
+
+    def __init__(self, cache_size: int = 10000, ttl: int = 300):
+        self.guild = None
+        self.cache = LRUCache(cache_size)
+        self.ttl = ttl
+        self.gateway_hits = 0
+        self.rest_calls = 0
+
+    async def get(self, did: int) -> Optional[discord.Member]:
+        member = self.guild.get_member(did)
+        if member is not None:
+            self.gateway_hits += 1
+            return member
+        entry = self.cache.get(did)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        self.rest_calls += 1
+        try:
+            member = await self.guild.fetch_member(did)
+        except discord.NotFound:
+            member = None
+        self.cache.put(did, (member, time.monotonic()))
+        return member
+
+    async def get_all(self) -> List[discord.Member]:
+        """
+            Lists all guild members
+
+            Gateway member cache is used (requesting chunks if guild
+            is not chunked yet), REST paging is a fallback
+        """
+        if not self.guild.chunked:
+            try:
+                await self.guild.chunk()
+            except (discord.ClientException, asyncio.TimeoutError) as e:
+                MemberService.log.warn(f'Failed to chunk guild members: {e}')
+        if self.guild.chunked:
+            return list(self.guild.members)
+        MemberService.log.warn('Guild is not chunked, fetching members over REST')
+        members = [member async for member in self.guild.fetch_members(limit=None)]
+        # Members are fetched in pages of 1000
+        self.rest_calls += len(members) // 1000 + 1
+        return members
+
+    def invalidate(self, did: int):
+        self.cache.pop(did)
+
+    def clear(self):
+        self.cache.clear()
+
+
 class UserService(object):
 
     log = logging.getLogger('user-service')
@@ -63,57 +139,184 @@ class UserService(object):
     roles:          RoleService
     bot_cache:      Dict[int, discord.User]
 
-    def __init__(self, db: DB.DBSession, roles: RoleService):
+    # Discord id -> user state
+    cache:          LRUCache
+
+    def __init__(self, db: DB.DBSession, roles: RoleService, cache_size: int = 50000):
         self.db = db
         self.roles = roles
         self.bot_cache = {}
+        self.cache = LRUCache(cache_size)
         
     def mark_everyone_absent(self):
         self.db.query(DB.User).update({'roles': None, 'display_name': None})
         self.db.commit()
+        self.cache.clear()
 
     def cache_bot(self, duser: discord.User):
         if duser.bot:
             self.bot_cache[duser.id] = duser
             
-    def update_member(self, member: discord.Member) -> DB.User:
-        u_row = conv.member_row(member, self.roles.role_rows_did_map)
+    def __store_user(self, u_row: dict) -> conv.UserRef:
         user = self.db.update_or_add(DB.User, 'did', u_row)
+        self.db.flush()
+        user = conv.user_ref(user)
         self.db.commit()
         return user
+
+    def update_member(self, member: discord.Member) -> conv.UserRef:
+        user = self.__store_user(conv.member_row(member, self.roles.role_rows_did_map))
+        self.cache.put(member.id, user)
+        return user
+
+    async def update_member_async(self, member: discord.Member) -> conv.UserRef:
+        # Row is built in event loop, written in DB thread
+        u_row = conv.member_row(member, self.roles.role_rows_did_map)
+        user = await self.db.run_async(self.__store_user, u_row)
+        self.cache.put(member.id, user)
+        return user
+
+    def sync_members(self, members: List[discord.Member], chunk_size: int = 1000) -> Dict[int, int]:
+        """
+            Bulk version of update_member for full member list
+
+            Users missing from the list are marked absent.
+            Returns users.id by discord id for every member
+        """
+        rows = [conv.member_row(m, self.roles.role_rows_did_map) for m in members]
+        known = {u.did: u for u in self.db.query(DB.User.id, DB.User.did, DB.User.name, DB.User.disc,
+                                                  DB.User.display_name, DB.User.roles, DB.User.created_at)}
+        # Write only new and changed users
+        changed = [r for r in rows if r['did'] not in known or conv.is_row_changed(known[r['did']], r)]
+        for chunk in chunks(changed, chunk_size):
+            self.db.upsert(DB.User, 'did', chunk, chunk_size=chunk_size)
+            self.db.commit()
+        # Mark absent
+        present = {r['did'] for r in rows}
+        absent = [u.id for u in known.values() if u.did not in present and u.roles is not None]
+        for chunk in chunks(absent, chunk_size):
+            self.db.query(DB.User).filter(DB.User.id.in_(chunk))\
+                .update({'roles': None, 'display_name': None}, synchronize_session=False)
+            self.db.commit()
+        # Resolve ids
+        user_ids = {did: known[did].id for did in present if did in known}
+        new_dids = [did for did in present if did not in known]
+        for chunk in chunks(new_dids, chunk_size):
+            user_ids.update(self.db.query(DB.User.did, DB.User.id).filter(DB.User.did.in_(chunk)))
+        return user_ids
+
+    def refresh_cache(self, members: List[discord.Member], user_ids: Dict[int, int]):
+        # Apply sync_members result to cached users
+        rows = {m.id: conv.member_row(m, self.roles.role_rows_did_map) for m in members}
+        for did in self.cache:
+            if did in rows:
+                self.cache.put(did, conv.row_user_ref(user_ids[did], rows[did]))
+            else:
+                self.cache.put(did, self.cache.peek(did)._replace(roles=None, display_name=None))
             
     def add_user(self, user: discord.User) -> DB.User:
         u_row = conv.user_row(user)
-        user = self.db.add(DB.User, u_row)
+        user = self.db.add(DB.User, u_row, need_flush=True)
+        self.cache.put(user.did, conv.user_ref(user))
         self.db.commit()
         return user
 
-    def remove_absent(self):
+    async def remove_absent_async(self):
+        await self.db.run_async(self.__remove_absent_users)
+        for did in self.cache:
+            if self.is_absent(self.cache.peek(did)):
+                self.cache.pop(did)
+
+    def __remove_absent_users(self):
         self.db.query(DB.User).filter_by(roles=None).delete()
         self.db.commit()
 
     def is_absent(self, user: DB.User):
         return user.roles is None
 
-    def remove(self, member: discord.Member) -> bool:
-        user = self.get(member)
+    def remove(self, member: discord.Member) -> conv.UserRef:
+        self.cache.pop(member.id)
+        return self.__remove_user(member.id)
+
+    def __remove_user(self, did: int) -> conv.UserRef:
+        user = q.get_user_by_did(self.db, did)
         if user is None:
             return None
-        user.delete()
+        ref = conv.user_ref(user)
+        self.db.delete_model(user)
         self.db.commit()
-        return user
+        return ref
+
+    async def remove_async(self, member: discord.Member) -> conv.UserRef:
+        self.cache.pop(member.id)
+        return await self.db.run_async(self.__remove_user, member.id)
         
-    def mark_absent(self, member: discord.Member) -> bool:
-        user = self.get(member)
+    def mark_absent(self, member: discord.Member) -> conv.UserRef:
+        self.cache.pop(member.id)
+        return self.__mark_user_absent(member.id)
+
+    def __mark_user_absent(self, did: int) -> conv.UserRef:
+        user = q.get_user_by_did(self.db, did)
         if user is None:
             return None
         user.roles = None
         user.display_name = None
+        self.db.flush()
+        ref = conv.user_ref(user)
         self.db.commit()
+        return ref
+
+    async def mark_absent_async(self, member: discord.Member) -> conv.UserRef:
+        self.cache.pop(member.id)
+        return await self.db.run_async(self.__mark_user_absent, member.id)
+
+    def get(self, member: discord.User) -> conv.UserRef:
+        return self.get_by_did(member.id)
+
+    def get_by_did(self, did: int) -> conv.UserRef:
+        user = self.cache.get(did)
+        if user is not None:
+            return user
+        user = self.__load_user(did)
+        if user is not None:
+            self.cache.put(did, user)
         return user
 
-    def get(self, member: discord.User) -> DB.User:
-        return q.get_user_by_did(self.db, member.id)
+    def __load_user(self, did: int) -> conv.UserRef:
+        row = q.get_user_by_did(self.db, did)
+        return conv.user_ref(row) if row is not None else None
+
+    async def get_async(self, member: discord.User) -> conv.UserRef:
+        return await self.get_by_did_async(member.id)
+
+    async def get_by_did_async(self, did: int) -> conv.UserRef:
+        # Cache miss is loaded in DB thread
+        user = self.cache.get(did)
+        if user is not None:
+            return user
+        user = await self.db.run_async(self.__load_user, did)
+        if user is not None:
+            self.cache.put(did, user)
+        return user
+
+    def get_present_users(self) -> List[tuple]:
+        return self.db.query(DB.User.id, DB.User.did, DB.User.roles).filter(DB.User.roles != None).all()
+
+    async def update_role_masks_async(self, masks: Dict[int, Tuple[int, str]]):
+        """
+            Stores role masks given as did -> (user id, mask)
+        """
+        rows = [{'id': user_id, 'roles': mask} for user_id, mask in masks.values()]
+        await self.db.run_async(self.__store_role_masks, rows)
+        for did, (_, mask) in masks.items():
+            user = self.cache.peek(did)
+            if user is not None:
+                self.cache.put(did, user._replace(roles=mask))
+
+    def __store_role_masks(self, rows: List[dict]):
+        for chunk in chunks(rows, 1000):
+            self.db.update_bulk(DB.User, chunk)
+            self.db.commit()
 
     def get_by_display_name(self, display_name: str) -> DB.User:
         return self.db.query(DB.User).filter_by(display_name=display_name).first()
@@ -132,29 +335,170 @@ class EventService(object):
 
     # Members passed via constructor
     db:         DB.DBSession
+    queue:      DB.IngestQueue
 
     # Maps
     event_type_map: Dict[str, int]
 
-    def __init__(self, db: DB.DBSession):
+    # Recent message index: message id -> message ref
+    messages:       LRUCache
+    message_filter: ScalableBloomFilter
+
+    # Filter is authoritative only after warm up
+    __indexed:      bool
+
+    # Early flush state
+    __flushing:     bool
+    __flush_failed: bool
+
+    def __init__(self, db: DB.DBSession, queue: DB.IngestQueue, message_cache_size: int = 100000, message_filter_capacity: int = 1000000):
         self.db = db
+        self.queue = queue
         self.event_type_map = {row.name:row.id for row in self.db.query(DB.EventType)}
+        self.messages = LRUCache(message_cache_size)
+        self.message_filter = ScalableBloomFilter(message_filter_capacity)
+        self.__indexed = False
+        self.__flushing = False
+        self.__flush_failed = False
+
+    def get_flush_task(self, **kwargs) -> asyncio.AbstractEventLoop:
+        loop = kwargs.get('loop') or asyncio.get_event_loop()
+        # Full batch wakes flusher, queue may be filled from DB thread
+        self.queue.on_full = lambda: loop.call_soon_threadsafe(self.__request_flush)
+        @tasks.loop(**kwargs)
+        async def queue_flush_task():
+            await self.flush_async()
+        return queue_flush_task
+
+    async def flush_async(self) -> bool:
+        try:
+            await self.db.run_async(self.queue.flush)
+            self.__flush_failed = False
+            return True
+        except Exception as e:
+            self.__flush_failed = True
+            EventService.log.error(f'Failed to flush ingest queue ({len(self.queue)} rows pending): {e}')
+            return False
+
+    def __request_flush(self):
+        # Failed flush is retried by schedule only
+        if self.__flushing or self.__flush_failed:
+            return
+        self.__flushing = True
+        asyncio.ensure_future(self.__early_flush())
+
+    async def __early_flush(self):
+        try:
+            await self.flush_async()
+        finally:
+            self.__flushing = False
 
     def check_event_name(self, name: str):
         if name not in self.event_type_map:
             raise NameError(f"No such event name: {name}")
 
-    def get_last_vc_event(self, user: DB.User, channel: discord.VoiceChannel) -> int:
-        return q.get_last_vc_event_by_id(self.db, user.id, channel.id)
+    def sync_pending(self, model: DB.BaseModel):
+        # Queued rows must be visible to lookups
+        if self.queue.pending(model) > 0:
+            self.queue.flush()
+
+    def get_open_vc_session(self, user: DB.User, channel: discord.VoiceChannel) -> DB.VoiceSession:
+        return q.get_open_vc_session(self.db, user.id, channel.id)
 
     def get_last_member_event(self, member: discord.Member) -> int:
+        self.sync_pending(DB.MemberEvent)
         return q.get_last_member_event_by_did(self.db, member.id)
 
     def get_last_user_member_event(self, user: DB.User) -> int:
+        self.sync_pending(DB.MemberEvent)
         return q.get_last_member_event_by_id(self.db, user.id)
 
-    def get_message(self, did: int):
-        return q.get_msg_by_did(self.db, did)
+    def add_to_bucket(self, user_id: int, event_name: str, day: date, channel_id: int, count: int = 1, seconds: int = 0):
+        row = conv.event_bucket_row(user_id, self.type_id(event_name), day, channel_id, count, seconds)
+        self.queue.accumulate(DB.EventBucket, ['user_id', 'day', 'channel_id', 'type_id'], row, ['count', 'seconds'])
+
+    def rebuild_buckets(self):
+        """
+            Rebuilds event buckets from raw events
+        """
+        self.queue.flush()
+        self.db.query(DB.EventBucket).delete()
+        self.db.execute(q.insert_event_buckets_from_select(q.select_message_buckets()))
+        self.db.execute(q.insert_event_buckets_from_select(q.select_vc_buckets(self.type_id("vc_join"))))
+        self.db.execute(q.reset_stat_watermarks())
+        self.db.commit()
+
+    def migrate_vc_events(self):
+        """
+            Converts legacy vc_events join/leave pairs into vc sessions once
+        """
+        if self.db.query(DB.VoiceSession.id).first() is not None:
+            return
+        join_id = self.type_id("vc_join")
+        if self.db.query(DB.VoiceChatEvent.id).filter(DB.VoiceChatEvent.type_id == join_id).first() is None:
+            return
+        EventService.log.warn('Migrating vc events into vc sessions')
+        self.queue.flush()
+        self.db.execute(q.insert_vc_sessions_from_events(join_id))
+        self.db.commit()
+
+    def migrate_event_buckets(self):
+        """
+            Fills event buckets from raw events once on upgrade
+        """
+        if self.db.query(DB.EventBucket.id).first() is not None:
+            return
+        has_messages = self.db.query(DB.MessageEvent.id).first() is not None
+        has_sessions = self.db.query(DB.VoiceSession.id).filter(DB.VoiceSession.ended_at != None).first() is not None
+        if not has_messages and not has_sessions:
+            return
+        EventService.log.warn('Filling event buckets from raw events')
+        self.rebuild_buckets()
+
+    async def get_message_async(self, did: int) -> conv.MessageRef:
+        # Filter has no false negatives, so unknown messages skip db
+        if self.__indexed and did not in self.message_filter:
+            return None
+        msg = self.messages.get(did)
+        if msg is not None:
+            return msg
+        msg = await self.db.run_async(self.__load_message, did)
+        if msg is not None:
+            self.messages.put(did, msg)
+        return msg
+
+    def __load_message(self, did: int) -> conv.MessageRef:
+        self.sync_pending(DB.MessageEvent)
+        row = q.get_msg_ref_by_did(self.db, did)
+        return conv.MessageRef(*row) if row is not None else None
+
+    def index_message(self, msg: conv.MessageRef):
+        self.message_filter.add(msg.message_id)
+        self.messages.put(msg.message_id, msg)
+
+    async def warm_message_index(self, chunk_size: int = 10000):
+        """
+            Loads known messages into index
+
+            Filter gets every stored message, cache keeps the most recent ones.
+            Chunks are fetched in db thread and applied in event loop.
+            Runs alongside event handling, lookups hit db until it is done
+        """
+        type_id, last_id, total = self.type_id("new_message"), 0, 0
+        while True:
+            try:
+                rows = await self.db.run_async(q.get_new_msg_refs, self.db, type_id, last_id, chunk_size)
+            except Exception as e:
+                EventService.log.error(f'Failed to index messages ({total} indexed): {e}')
+                return
+            for row in rows:
+                self.index_message(conv.MessageRef(*row[1:]))
+            total += len(rows)
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+        self.__indexed = True
+        EventService.log.info(f'Indexed {total} messages ({self.message_filter.stages} filter stages)')
 
     def type_id(self, event_name: str) -> int:
         return self.event_type_map[event_name]
@@ -162,69 +506,117 @@ class EventService(object):
     def repair_member_joined_event(self, member: discord.Member, user: DB.User):
         last_event = self.get_last_user_member_event(user)
         if last_event is None or last_event.type_id != self.type_id("member_join"):
-            e_row = conv.member_join_row(user, member.joined_at, self.event_type_map)
+            e_row = conv.member_join_row(user.id, member.joined_at, self.event_type_map)
             last_event = self.db.add(DB.MemberEvent, e_row)
         last_event.created_at = member.joined_at
         self.db.commit()
 
-    def repair_vc_leave_event(self, user: DB.User, channel: discord.VoiceChannel):
-        last_event = self.get_last_vc_event(user, channel)
-        if last_event is not None and last_event.type_id == self.type_id("vc_join"):
-            EventService.log.warn(f'VC leave event is absent for last vc_join event for {user} in <{channel.name}! Removing last vc_join event!')
-            self.db.delete_model(last_event)
+    def repair_member_joined_events(self, members: List[discord.Member], user_ids: Dict[int, int], chunk_size: int = 1000):
+        """
+            Bulk version of repair_member_joined_event
+        """
+        self.sync_pending(DB.MemberEvent)
+        join_id = self.type_id("member_join")
+        last_events = {e.user_id: e for e in q.get_last_member_events(self.db)}
+        inserts, updates = [], []
+        for member in members:
+            user_id = user_ids[member.id]
+            last_event = last_events.get(user_id)
+            if last_event is None or last_event.type_id != join_id:
+                inserts.append(conv.member_join_row(user_id, member.joined_at, self.event_type_map))
+            elif not conv.same_timestamp(last_event.created_at, member.joined_at):
+                updates.append({'id': last_event.id, 'created_at': member.joined_at})
+        for chunk in chunks(inserts, chunk_size):
+            self.db.add_bulk(DB.MemberEvent, chunk)
+            self.db.commit()
+        for chunk in chunks(updates, chunk_size):
+            self.db.update_bulk(DB.MemberEvent, chunk)
             self.db.commit()
 
+    def repair_vc_session(self, user: DB.User, channel: discord.VoiceChannel):
+        session = self.get_open_vc_session(user, channel)
+        if session is not None:
+            EventService.log.warn(f'VC leave is absent for open vc session of {user} in <{channel.name}! Removing open vc session!')
+            self.db.delete_model(session)
+            self.db.commit()
+
+    async def repair_vc_session_async(self, user: DB.User, channel: discord.VoiceChannel):
+        await self.db.run_async(self.repair_vc_session, user, channel)
+
     def create_member_join_event(self, user: DB.User, member: discord.Member):
-        e_row = conv.member_join_row(user, member.joined_at, self.event_type_map)
-        self.db.add(DB.MemberEvent, e_row)
-        self.db.commit()
+        e_row = conv.member_join_row(user.id, member.joined_at, self.event_type_map)
+        self.queue.put(DB.MemberEvent, e_row)
 
     def create_user_leave_event(self, user: DB.User):
         e_row = conv.user_leave_row(user, self.event_type_map)
-        self.db.add(DB.MemberEvent, e_row)
-        self.db.commit()
+        self.queue.put(DB.MemberEvent, e_row)
 
     def create_new_message_event(self, user: DB.User, message: discord.Message):
         row = conv.new_message_to_row(user.id, message, self.event_type_map)
-        self.db.add(DB.MessageEvent, row)
-        self.db.commit()
+        self.queue.put(DB.MessageEvent, row)
+        self.add_to_bucket(user.id, "new_message", message.created_at.date(), message.channel.id)
+        self.index_message(conv.message_ref(user.did, row))
 
-    def create_message_edit_event(self, msg: DB.MessageEvent):
+    def create_message_edit_event(self, msg: conv.MessageRef):
         row = conv.message_edit_row(msg, self.event_type_map)
-        self.db.add(DB.MessageEvent, row)
-        self.db.commit()
+        self.queue.put(DB.MessageEvent, row)
+        self.add_to_bucket(msg.user_id, "message_edit", datetime.utcnow().date(), msg.channel_id)
 
-    def create_message_delete_event(self, msg: DB.MessageEvent):
+    def create_message_delete_event(self, msg: conv.MessageRef):
         row = conv.message_delete_row(msg, self.event_type_map)
-        self.db.add(DB.MessageEvent, row)
-        self.db.commit()
+        self.queue.put(DB.MessageEvent, row)
+        self.add_to_bucket(msg.user_id, "message_delete", datetime.utcnow().date(), msg.channel_id)
 
-    def create_vc_join_event(self, user: DB.User, channel: discord.VoiceChannel):
-        e_row = conv.vc_join_row(user, channel, self.event_type_map)
-        self.db.add(DB.VoiceChatEvent, e_row)
+    def __start_vc_session(self, user: DB.User, channel: discord.VoiceChannel):
+        # Start time is set by DB, so session is written right away
+        self.db.add(DB.VoiceSession, conv.vc_session_row(user.id, channel.id))
         self.db.commit()
 
-    def create_vc_leave_event(self, user: DB.User, channel: discord.VoiceChannel):
-        e_row = conv.vc_leave_row(user, channel, self.event_type_map)
-        self.db.add(DB.VoiceChatEvent, e_row)
+    async def open_vc_session(self, user: DB.User, channel: discord.VoiceChannel):
+        await self.db.run_async(self.__start_vc_session, user, channel)
+
+    def __end_vc_session(self, user: DB.User, channel: discord.VoiceChannel) -> Optional[Tuple[date, int]]:
+        session = self.get_open_vc_session(user, channel)
+        if session is None:
+            return None
+        session.ended_at = self.db.execute(q.select_now()).scalar()
+        session.duration = int((session.ended_at - session.started_at).total_seconds())
+        res = (session.ended_at.date(), session.duration)
         self.db.commit()
+        return res
+
+    async def close_vc_session(self, user: DB.User, channel: discord.VoiceChannel) -> Optional[int]:
+        """
+            Closes open vc session in DB thread
 
-    def close_vc_join_event(self, user: DB.User, channel: discord.VoiceChannel) -> DB.VoiceChatEvent:
-        last_event = self.get_last_vc_event(user, channel)
-        if last_event is None or last_event.type_id != self.type_id("vc_join"):
+            Returns session duration in seconds
+        """
+        res = await self.db.run_async(self.__end_vc_session, user, channel)
+        if res is None:
             # Skip absent vc join
-            EventService.log.warn(f'VC join event is absent for {user} in <{channel.name}! Skipping vc leave event!')
+            EventService.log.warn(f'Open vc session is absent for {user} in <{channel.name}! Skipping vc leave event!')
             return None
-        # Save event + update previous
-        e_row = conv.vc_leave_row(user, channel, self.event_type_map)
-        self.db.add(DB.VoiceChatEvent, e_row)
-        self.db.touch(DB.VoiceChatEvent, last_event.id)
+        # Session time goes to bucket of the day it ends
+        day, duration = res
+        self.add_to_bucket(user.id, "vc_join", day, channel.id, seconds=duration)
+        return duration
+
+    async def clear_text_channel_history_async(self, channel: discord.TextChannel):
+        await self.db.run_async(self.__clear_channel_events, channel.id)
+        for did in self.messages:
+            if self.messages.peek(did).channel_id == channel.id:
+                self.messages.pop(did)
+
+    def __clear_channel_events(self, channel_id: int):
+        self.queue.flush()
+        self.db.query(DB.MessageEvent).filter_by(channel_id=channel_id).delete()
+        self.db.query(DB.EventBucket).filter_by(channel_id=channel_id).delete()
+        self.db.execute(q.reset_stat_watermarks())
         self.db.commit()
-        return last_event
 
-    def clear_text_channel_history(self, channel: discord.TextChannel):
-        self.db.query(DB.MessageEvent).filter_by(channel_id=channel.id).delete()
-        self.db.commit()
+    def drop_message_index(self):
+        self.messages.clear()
+        self.message_filter.clear()
 
 
 
@@ -232,6 +624,24 @@ class StatService(object):
 
     log = logging.getLogger('stat-service')
 
+    # Stats derived from user row on read, never stored
+    COMPUTED = ["membership"]
+
+    # Stats rebuilt from event buckets: name -> (event, column)
+    BUCKETED = {
+        "new_message_count": ("new_message", "count"),
+        "delete_message_count": ("message_delete", "count"),
+        "edit_message_count": ("message_edit", "count"),
+        "vc_time": ("vc_join", "seconds"),
+    }
+
+    # Stats summed from event buckets on read: name -> (event, column, days)
+    WINDOWED = {
+        "messages_7d": ("new_message", "count", 7),
+        "messages_30d": ("new_message", "count", 30),
+        "vc_time_30d": ("vc_join", "seconds", 30),
+    }
+
     # Members passed via constructor
     events:     EventService
     db:         DB.DBSession
@@ -239,77 +649,507 @@ class StatService(object):
     # Maps
     user_stat_type_map: Dict[str, int]
 
-    def __init__(self, db: DB.DBSession, events: EventService):
+    # Write-behind stat cache: (user_id, type_id) -> value
+    cache:      LRUCache
+    __dirty:    Set[Tuple[int, int]]
+    __evicted:  Dict[Tuple[int, int], int]
+
+    # Watermarks are taken with a lag to cover writes committed after snapshot
+    WATERMARK_LAG = timedelta(minutes=5)
+
+    # Rebuilds started per stat: type_id -> count
+    __rebuild_epochs: Dict[int, int]
+
+    # Writes made while stat is rebuilt: type_id -> user_id -> (set value or None, delta)
+    __journals:     Dict[int, Dict[int, Tuple[Optional[int], int]]]
+    __rebuild_lock: asyncio.Lock
+
+    def __init__(self, db: DB.DBSession, events: EventService, cache_size: int = 100000):
         self.db = db
         self.events = events
         self.user_stat_type_map = {row.name:row.id for row in self.db.query(DB.UserStatType)}
+        self.cache = LRUCache(cache_size, on_evict=self.__on_evict)
+        self.__dirty = set()
+        self.__evicted = {}
+        self.__journals = {}
+        self.__rebuild_epochs = {}
+        self.__rebuild_lock = asyncio.Lock()
+
+    def __on_evict(self, key: Tuple[int, int], value: int):
+        # Dirty values are kept aside until next flush
+        if key in self.__dirty:
+            self.__dirty.discard(key)
+            self.__evicted[key] = value
+
+    def __cache_put(self, key: Tuple[int, int], value: int):
+        self.cache.put(key, value)
+        self.__dirty.add(key)
+
+    def get_flush_task(self, **kwargs) -> asyncio.AbstractEventLoop:
+        @tasks.loop(**kwargs)
+        async def stat_flush_task():
+            try:
+                await self.flush_async()
+            except Exception as e:
+                StatService.log.error(f'Failed to flush stat cache: {e}')
+        return stat_flush_task
+
+    def __take_dirty(self) -> List[dict]:
+        rows = [conv.user_stat_row(u, t, self.cache.peek((u, t))) for (u, t) in self.__dirty]
+        rows += [conv.user_stat_row(u, t, v) for (u, t), v in self.__evicted.items()]
+        self.__dirty, self.__evicted = set(), {}
+        return rows
+
+    def __restore_dirty(self, rows: List[dict]):
+        for row in rows:
+            key = (row['user_id'], row['type_id'])
+            if key in self.cache:
+                self.__dirty.add(key)
+            elif key not in self.__evicted:
+                self.__evicted[key] = row['value']
+
+    def __write_rows(self, rows: List[dict]):
+        if rows:
+            self.db.upsert(DB.UserStat, ['user_id', 'type_id'], rows)
+            self.db.commit()
+        # Queued increments of uncached stats
+        self.events.sync_pending(DB.UserStat)
+
+    async def flush_async(self) -> int:
+        # Snapshot on loop thread, write in DB thread
+        rows = self.__take_dirty()
+        try:
+            await self.db.run_async(self.__write_rows, rows)
+        except Exception:
+            self.__restore_dirty(rows)
+            raise
+        return len(rows)
+
+    def drop_cache(self, stat_name: str = None):
+        """
+            Drops cached stat values
+
+            Dropping single stat keeps unflushed values, those are
+            newer than stored ones. Dropping all discards everything
+        """
+        if stat_name is None:
+            self.cache.clear()
+            self.__dirty, self.__evicted = set(), {}
+            return
+        type_id = self.type_id(stat_name)
+        for key in self.cache:
+            if key[1] == type_id and key not in self.__dirty:
+                self.cache.pop(key)
 
-    def get_stat_update_task(self, mtx: asyncio.Lock, **kwargs) -> asyncio.AbstractEventLoop:
+    def get_stat_update_task(self, **kwargs) -> asyncio.AbstractEventLoop:
         @tasks.loop(**kwargs)
         async def stat_update_task():
             StatService.log.info("Scheduled stat update")
-            async with mtx:
-                for stat_name in self.user_stat_type_map:
-                    self.reload_stat(stat_name)
-            StatService.log.info("Done scheduled stat update")
+            timings = await self.reload_stats_async(list(self.user_stat_type_map), full=False)
+            StatService.log.info(f"Done scheduled stat update in {sum(timings.values()):.2f}s of work")
         return stat_update_task
 
     def check_stat_name(self, name: str):
         if name not in self.user_stat_type_map:
             raise NameError(f"No such stat name: {name}")
 
-    def __reload_stat(self, query, stat: str, event: str):
+    def check_stat_writable(self, name: str):
+        self.check_stat_name(name)
+        if name in StatService.COMPUTED or name in StatService.WINDOWED:
+            raise NameError(f"Stat is read-only: {name}")
+
+    @staticmethod
+    def membership(user: DB.User, now: datetime = None) -> int:
+        # Join timestamp is kept in user creation time
+        if user.roles is None or user.created_at is None:
+            return 0
+        now = now or datetime.utcnow()
+        return max((now - user.created_at).days, 0)
+
+    def __windows(self, names: List[str]) -> Dict[str, tuple]:
+        today = datetime.utcnow().date()
+        windows = {}
+        for name in names:
+            event, column, days = StatService.WINDOWED[name]
+            windows[name] = (self.events.type_id(event), column, today - timedelta(days=days - 1))
+        return windows
+
+    def __reload_stat(self, query, stat: str, event: str, partial: bool = False, on_swap=None):
         stat_id = self.user_stat_type_map[stat]
         event_id = self.events.type_id(event)
-        self.db.query(DB.UserStat).filter_by(type_id=stat_id).delete()
-        self.db.commit()
+        self.events.queue.flush()
+        # Build new values aside, readers keep seeing old ones
+        self.db.query(DB.UserStatStaging).filter_by(type_id=stat_id).delete()
         select_query = query(event_id, [('type_id',stat_id)])
-        insert_query = q.insert_user_stat_from_select(select_query)
-        self.db.execute(insert_query)
+        self.db.execute(q.insert_user_stat_staging_from_select(select_query))
+        self.db.commit()
+        # Swap in one transaction, partial reload replaces staged users only
+        stale = self.db.query(DB.UserStat).filter(DB.UserStat.type_id == stat_id)
+        if partial:
+            stale = stale.filter(DB.UserStat.user_id.in_(q.select_staged_user_ids(stat_id)))
+        stale.delete(synchronize_session=False)
+        self.db.execute(q.insert_user_stat_from_select(q.select_staged_user_stats(stat_id)))
+        self.db.query(DB.UserStatStaging).filter_by(type_id=stat_id).delete()
+        if on_swap is not None:
+            on_swap()
         self.db.commit()
 
+    def __reload_bucket_stat(self, stat: str, full: bool):
+        event, column = StatService.BUCKETED[stat]
+        stat_id = self.type_id(stat)
+        # Incremental reload recomputes users with buckets touched since last one
+        self.db.upsert(DB.UserStatWatermark, 'type_id', [{ 'type_id': stat_id }])
+        self.db.commit()
+        watermark, generation = self.db.query(DB.UserStatWatermark.watermark, DB.UserStatWatermark.generation) \
+                                       .filter_by(type_id=stat_id).one()
+        since = watermark if not full else None
+        snapshot = self.db.execute(q.select_now()).scalar() - StatService.WATERMARK_LAG
+        query = lambda type_id, lit_values: q.select_bucket_sum_per_user(type_id, lit_values, column, since)
+        # Watermark is moved in swap transaction
+        on_swap = lambda: self.db.execute(q.update_stat_watermark(stat_id, generation, snapshot))
+        self.__reload_stat(query, stat, event, partial=since is not None, on_swap=on_swap)
+
     def type_id(self, stat_name):
         return self.user_stat_type_map[stat_name]
 
-    def get(self, user: DB.User, stat_name: str) -> int:
-        self.check_stat_name(stat_name)
-        stat = q.get_user_stat_by_id(self.db, user.id, self.type_id(stat_name))
-        return stat.value if stat is not None else 0
+    async def get_async(self, user: DB.User, stat_name: str) -> int:
+        return (await self.get_many_async(user, [stat_name]))[stat_name]
+
+    async def get_many_async(self, user: DB.User, names: List[str]) -> Dict[str, int]:
+        """
+            Gets several stats of user
+
+            Values missing in cache are fetched in one query in db thread
+            together with deltas queued for them, windowed stats are summed
+            from stored and queued event buckets
+        """
+        values, missing = self.__get_cached(user, names)
+        windowed = [name for name in names if name in StatService.WINDOWED]
+        if missing or windowed:
+            epochs = dict(self.__rebuild_epochs)
+            loaded, sums = await self.db.run_async(self.__load_stats, user.id, missing, self.__windows(windowed))
+            self.__put_loaded(user.id, missing, loaded, epochs, values)
+            values.update(sums)
+        return values
+
+    def __get_cached(self, user: DB.User, names: List[str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        for name in names:
+            self.check_stat_name(name)
+        values, missing = {}, {}
+        for name in names:
+            if name in StatService.COMPUTED:
+                values[name] = getattr(StatService, name)(user)
+                continue
+            if name in StatService.WINDOWED:
+                continue
+            key = (user.id, self.type_id(name))
+            value = self.cache.get(key)
+            if value is None and key in self.__evicted:
+                self.__cache_put(key, self.__evicted.pop(key))
+                value = self.cache.peek(key)
+            if value is None:
+                missing[name] = key[1]
+            else:
+                values[name] = value
+        return values, missing
+
+    def __load_stats(self, user_id: int, missing: Dict[str, int], windows: Dict[str, tuple]) -> Tuple[Dict[str, Tuple[int, int]], Dict[str, int]]:
+        # Flushes are blocked, so queued deltas are taken over exactly once
+        # and queued buckets are not counted twice
+        loaded, sums = {}, {}
+        with self.events.queue.frozen():
+            if missing:
+                row = self.db.execute(q.select_user_stats_pivot(missing, user_id)).first()
+                for i, (name, type_id) in enumerate(missing.items()):
+                    rows = self.events.queue.collect(DB.UserStat, lambda r: r['user_id'] == user_id and r['type_id'] == type_id, take=True)
+                    loaded[name] = (int(row[i + 1]) if row is not None else 0, sum(r['value'] for r in rows))
+            if windows:
+                row = self.db.execute(q.select_bucket_window_sums(windows, user_id)).first()
+                buckets = self.events.queue.collect(DB.EventBucket, lambda r: r['user_id'] == user_id)
+                for i, (name, (type_id, column, since)) in enumerate(windows.items()):
+                    queued = sum(r[column] for r in buckets if r['type_id'] == type_id and r['day'] >= since)
+                    sums[name] = (int(row[i + 1]) if row is not None else 0) + queued
+        return loaded, sums
+
+    def __put_loaded(self, user_id: int, missing: Dict[str, int], loaded: Dict[str, Tuple[int, int]],
+                     epochs: Dict[int, int], values: Dict[str, int]):
+        for name, (stored, delta) in loaded.items():
+            key = (user_id, missing[name])
+            if key[1] in self.__journals or self.__rebuild_epochs.get(key[1], 0) != epochs.get(key[1], 0):
+                # Stored value may predate swap, bucket stats got the deltas rebuilt
+                if name not in StatService.BUCKETED and delta != 0:
+                    self.__apply_deltas({key: delta})
+                values[name] = stored + delta
+            elif key in self.cache or key in self.__evicted:
+                # Loaded meanwhile by another reader
+                if delta != 0:
+                    self.__add_many({key: delta})
+                values[name] = self.cache.peek(key) if key in self.cache else self.__evicted[key]
+            else:
+                if delta != 0:
+                    self.__cache_put(key, stored + delta)
+                else:
+                    self.cache.put(key, stored)
+                values[name] = stored + delta
+
+    async def get_all_users(self, names: List[str]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+            Gets several stats of every user in one query
 
-    def set(self, user: DB.User, stat_name: str, value: int):
-        type_id = self.type_id(stat_name)
-        stat = q.get_user_stat_by_id(self.db, user.id, type_id)
-        if stat is None:
-            empty_stat_row = conv.empty_user_stat_row(user.id, type_id)
-            stat = self.db.add(DB.UserStat, empty_stat_row)
-        stat.value = value
-        self.db.commit()
+            Dirty cache and ingest queue are flushed first, columns are loaded in db thread.
+            See load_columns for result layout
+        """
+        await self.flush_async()
+        if any(name in StatService.WINDOWED for name in names):
+            await self.events.flush_async()
+        return await self.db.run_async(self.load_columns, names)
 
-    def reload_stat(self, name: str):
+    def set(self, user: DB.User, stat_name: str, value: int):
+        self.check_stat_writable(stat_name)
+        key = (user.id, self.type_id(stat_name))
+        # Stats being rebuilt get value after swap
+        journal = self.__journals.get(key[1])
+        if journal is not None:
+            journal[key[0]] = (value, 0)
+            return
+        self.__cache_put(key, value)
+
+    def increment(self, user: DB.User, stat_name: str, delta: int = 1):
+        self.increment_many([(user, stat_name, delta)])
+
+    def increment_many(self, deltas: List[tuple]):
+        """
+            Adds (user, stat_name, delta) values to stats
+
+            Cached stats are updated in memory and flushed later,
+            the rest is queued as counters and added on queue flush
+        """
+        merged = {}
+        for user, stat_name, delta in deltas:
+            self.check_stat_writable(stat_name)
+            key = (user.id, self.type_id(stat_name))
+            merged[key] = merged.get(key, 0) + int(delta)
+        self.__apply_deltas(merged)
+
+    def __apply_deltas(self, merged: Dict[Tuple[int, int], int]):
+        # Stats being rebuilt get deltas after swap
+        for key in list(merged):
+            journal = self.__journals.get(key[1])
+            if journal is not None:
+                value, delta = journal.get(key[0], (None, 0))
+                journal[key[0]] = (value, delta + merged.pop(key))
+        self.__add_many(merged)
+
+    def __add_many(self, merged: Dict[Tuple[int, int], int]):
+        for key in list(merged):
+            if key in self.cache:
+                self.__cache_put(key, self.cache.peek(key) + merged.pop(key))
+            elif key in self.__evicted:
+                self.__cache_put(key, self.__evicted.pop(key) + merged.pop(key))
+        # The rest is added on queue flush
+        for (user_id, type_id), delta in merged.items():
+            if delta != 0:
+                row = conv.user_stat_row(user_id, type_id, delta)
+                self.events.queue.accumulate(DB.UserStat, ['user_id', 'type_id'], row, ['value'])
+
+    def load_columns(self, names: List[str]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+            Loads stats of all users as columns
+
+            Returns user ids array and value array per stat name,
+            rows are aligned. Dirty cache values and queued event
+            buckets should be flushed first
+        """
+        for name in names:
+            self.check_stat_name(name)
+        users = self.db.query(DB.User.id, DB.User.created_at, DB.User.roles).order_by(DB.User.id).all()
+        user_ids = np.array([user.id for user in users], dtype=np.int64)
+        columns = {name: np.zeros(len(users), dtype=np.int64) for name in names}
+        now = datetime.utcnow()
+        for name in names:
+            if name in StatService.COMPUTED:
+                columns[name] = np.array([getattr(StatService, name)(user, now) for user in users], dtype=np.int64)
+        if not users:
+            return user_ids, columns
+        # Stored stats in one pivot query, windowed ones in another
+        type_ids = {name: self.type_id(name) for name in names if name not in StatService.COMPUTED and name not in StatService.WINDOWED}
+        windowed = [name for name in names if name in StatService.WINDOWED]
+        if type_ids:
+            self.__fill_columns(user_ids, columns, list(type_ids), self.db.execute(q.select_user_stats_pivot(type_ids)).fetchall())
+        if windowed:
+            rows = self.db.execute(q.select_bucket_window_sums(self.__windows(windowed))).fetchall()
+            self.__fill_columns(user_ids, columns, windowed, rows)
+        return user_ids, columns
+
+    @staticmethod
+    def __fill_columns(user_ids: np.ndarray, columns: Dict[str, np.ndarray], names: List[str], rows: list):
+        # Rows are (user_id, value per name), users without row keep zeros
+        table = np.array([tuple(row) for row in rows], dtype=np.int64).reshape(-1, len(names) + 1)
+        index = np.minimum(np.searchsorted(user_ids, table[:, 0]), len(user_ids) - 1)
+        known = user_ids[index] == table[:, 0]
+        for i, name in enumerate(names):
+            columns[name][index[known]] = table[known, i + 1]
+
+    def reload_stat(self, name: str, full: bool = True):
         self.check_stat_name(name)
         if hasattr(self, f'reload_{name}_stat'):
             hook = getattr(self, f'reload_{name}_stat')
-            hook()
+            hook(full)
         else:
-            self.reload_stat_default()
-
-    def reload_stat_default(self):
+            self.reload_stat_default(full)
+
+    async def reload_stat_async(self, name: str, full: bool = True):
+        await self.reload_stats_async([name], full=full)
+
+    async def reload_stats_async(self, names: List[str], progress=None, full: bool = True) -> Dict[str, float]:
+        """
+            Reloads several stats concurrently
+
+            Each stat is recalculated in DB worker thread on its own connection
+            and swapped in atomically, writes made meanwhile are journaled
+            and applied after swap. Unless `full` is set only users with event
+            buckets touched since previous reload are recalculated.
+            `progress(name, seconds, done, total)` is awaited as each stat is
+            done. Returns reload time per stat
+        """
+        for name in names:
+            self.check_stat_name(name)
+        async with self.__rebuild_lock:
+            return await self.__reload_stats_async(names, progress, full)
+
+    def __bucket_types(self, name: str) -> List[int]:
+        if name not in StatService.BUCKETED:
+            return []
+        return [self.events.type_id(StatService.BUCKETED[name][0])]
+
+    def __finish_rebuild(self, name: str):
+        type_id = self.type_id(name)
+        journal = self.__journals.pop(type_id)
+        self.events.queue.release(DB.EventBucket, 'type_id', self.__bucket_types(name))
+        # Stored values are fresh now, journaled writes go on top
+        self.drop_cache(name)
+        deltas = {}
+        for user_id, (value, delta) in journal.items():
+            if value is not None:
+                self.__cache_put((user_id, type_id), value + delta)
+            elif delta != 0:
+                deltas[(user_id, type_id)] = delta
+        self.__add_many(deltas)
+
+    async def __reload_stats_async(self, names: List[str], progress, full: bool) -> Dict[str, float]:
+        # Events journaled from now on are kept out of buckets until swap,
+        # so rebuild does not see them twice
+        for name in names:
+            self.__journals[self.type_id(name)] = {}
+            self.__rebuild_epochs[self.type_id(name)] = self.__rebuild_epochs.get(self.type_id(name), 0) + 1
+            self.events.queue.hold(DB.EventBucket, 'type_id', self.__bucket_types(name))
+        try:
+            await self.flush_async()
+            await self.db.run_async(self.events.queue.flush)
+        except Exception:
+            for name in names:
+                self.__finish_rebuild(name)
+            raise
+        timings = {}
+
+        async def reload(name: str):
+            start = time.monotonic()
+            try:
+                await self.db.run_worker(self.reload_stat, name, full)
+            finally:
+                self.__finish_rebuild(name)
+            timings[name] = time.monotonic() - start
+            StatService.log.info(f"Reloaded {name} in {timings[name]:.2f}s")
+            if progress is not None:
+                await progress(name, timings[name], len(timings), len(names))
+
+        await asyncio.gather(*[reload(name) for name in names])
+        return timings
+
+    def reload_stat_default(self, full: bool):
         pass
 
-    def reload_membership_stat(self):
-        self.__reload_stat(q.select_membership_time_per_user, 'membership', 'member_join')
-
-    def reload_new_message_count_stat(self):
-        self.__reload_stat(q.select_message_count_per_user, 'new_message_count', 'new_message')
-
-    def reload_delete_message_count_stat(self):
-        self.__reload_stat(q.select_message_count_per_user, 'delete_message_count', 'message_delete')
-
-    def reload_edit_message_count_stat(self):
-        self.__reload_stat(q.select_message_count_per_user, 'edit_message_count', 'message_edit')
-
-    def reload_vc_time_stat(self):
-        self.__reload_stat(q.select_vc_time_per_user, 'vc_time', 'vc_join')
+    def reload_new_message_count_stat(self, full: bool):
+        self.__reload_bucket_stat('new_message_count', full)
+
+    def reload_delete_message_count_stat(self, full: bool):
+        self.__reload_bucket_stat('delete_message_count', full)
+
+    def reload_edit_message_count_stat(self, full: bool):
+        self.__reload_bucket_stat('edit_message_count', full)
+
+    def reload_vc_time_stat(self, full: bool):
+        self.__reload_bucket_stat('vc_time', full)
+
+
+class RankTable(object):
+    """
+        Rank config compiled into arrays sorted by weight
+
+        Evaluates effective rank for many users at once
+    """
+
+    # Stats required for evaluation
+    STATS = ["exact_weight", "min_weight", "max_weight", "membership", "new_message_count", "delete_message_count", "vc_time",
+             "messages_7d", "messages_30d", "vc_time_30d"]
+
+    # Rank thresholds
+    FIELDS = ["weight", "membership", "messages", "vc", "messages_7d", "messages_30d", "vc_30d"]
+
+    names:          List[str]
+    weight:         np.ndarray
+    membership:     np.ndarray
+    messages:       np.ndarray
+    vc:             np.ndarray
+    messages_7d:    np.ndarray
+    messages_30d:   np.ndarray
+    vc_30d:         np.ndarray
+
+    def __init__(self, ranks: ConfigView):
+        compiled = [(name, ConfigView(value=ranks[name], schema_name="rank_schema")) for name in ranks]
+        compiled.sort(key=lambda r: r[1]["weight"])
+        self.names = [name for name, _ in compiled]
+        for field in RankTable.FIELDS:
+            setattr(self, field, np.array([r[field] for _, r in compiled], dtype=np.int64))
+
+    def __len__(self):
+        return len(self.names)
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        return {name: {field: int(getattr(self, field)[i]) for field in RankTable.FIELDS} for i, name in enumerate(self.names)}
+
+    def evaluate(self, stats: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+            Finds rank index per user, -1 if no rank applicable
+
+            `stats` maps every name from `STATS` to column of values
+        """
+        exact = stats["exact_weight"][:, None]
+        min_w = stats["min_weight"][:, None]
+        max_w = stats["max_weight"][:, None]
+        messages = (stats["new_message_count"] - stats["delete_message_count"])[:, None]
+        # Users x ranks predicate matrices
+        meet = ((messages >= self.messages) | (stats["vc_time"][:, None] >= self.vc)) & (stats["membership"][:, None] >= self.membership)
+        meet &= stats["messages_7d"][:, None] >= self.messages_7d
+        meet &= stats["messages_30d"][:, None] >= self.messages_30d
+        meet &= stats["vc_time_30d"][:, None] >= self.vc_30d
+        meet &= (min_w <= 0) | (self.weight >= min_w)
+        meet &= (max_w <= 0) | (self.weight <= max_w)
+        meet |= (min_w > 0) & (self.weight == min_w)
+        meet &= self.weight > -1000
+        exact_meet = self.weight == exact
+        meet = np.where(exact > 0, exact_meet, meet)
+        # Highest weight rank is the last applicable one
+        found = meet.any(axis=1)
+        last = meet.shape[1] - 1 - np.argmax(meet[:, ::-1], axis=1)
+        return np.where(found, last, -1)
+
+    def name(self, index: int) -> Optional[str]:
+        return self.names[index] if index >= 0 else None
+
+
+# Planned rank roles change of one user
+RankChange = namedtuple('RankChange', ['user_id', 'did', 'add', 'remove', 'roles'])
 
 
 class RankingService(object):
@@ -323,10 +1163,14 @@ class RankingService(object):
     config:     ConfigView
     mtx:        asyncio.Lock
 
+    # Compiled ranks config
+    table:      RankTable
+
     def __init__(self, stats: StatService, roles: RoleService, config: ConfigView):
         self.stats = stats
         self.roles = roles
         self.config = config
+        self.table = None
 
     ###########
     # Methods #
@@ -352,57 +1196,84 @@ class RankingService(object):
                 dup_rank = ranks_weights[rank['weight']]
                 raise InvalidConfigException(f"Duplicate weights '{rank_name}', '{dup_rank}'", "bot.ranks.role")
             ranks_weights[rank['weight']] = rank_name
-
-    def find_user_rank_name(self, user: DB.User) -> Optional[str]:
-        # Gather stat values
-        exact_weight = self.stats.get(user, "exact_weight")
-        min_weight = self.stats.get(user, "min_weight")
-        max_weight = self.stats.get(user, "max_weight")
-        membership = self.stats.get(user, "membership")
-        messages = self.stats.get(user, "new_message_count") - self.stats.get(user, "delete_message_count")
-        vc_time = self.stats.get(user, "vc_time")
-        
-        # Prepare rank search
-        ranks = self.config["role"]
-        max_rank_weight = -1000
-        max_rank_name = None
-
-        # Search ranks
-        for rank_name in ranks:
-            rank = ConfigView(value=ranks[rank_name], schema_name="rank_schema")
-            # Handle exact
-            if exact_weight > 0:
-                if rank["weight"] == exact_weight:
-                    return rank_name
-                else:
-                    continue
-            # Handle minimal
-            if min_weight > 0:
-                if rank["weight"] == min_weight and max_rank_weight < rank["weight"]:
-                    max_rank_weight = rank["weight"]
-                    max_rank_name = rank_name
-                elif rank["weight"] < min_weight:
-                    continue
-            # Handle maximal
-            if max_weight > 0:
-                if rank["weight"] > max_weight:
-                    continue
-            # Predicate value
-            meet_requirements = (messages >= rank["messages"] or vc_time >= rank["vc"]) and membership >= rank["membership"]
-            # Result expression
-            if meet_requirements and max_rank_weight < rank["weight"]:
-                max_rank_weight = rank["weight"]
-                max_rank_name = rank_name
-        
-        return max_rank_name
+        self.table = RankTable(ranks)
+
+    def get_table(self) -> RankTable:
+        if self.table is None:
+            self.table = RankTable(self.config["role"])
+        return self.table
+
+    async def find_user_rank_name(self, user: DB.User) -> Optional[str]:
+        values = await self.stats.get_many_async(user, RankTable.STATS)
+        stats = {name: np.array([values[name]], dtype=np.int64) for name in RankTable.STATS}
+        table = self.get_table()
+        return table.name(table.evaluate(stats)[0])
+
+    async def find_user_rank_names(self, user_ids: List[int]) -> Dict[int, Optional[str]]:
+        """
+            Bulk version of find_user_rank_name
+
+            Loads stats of all users in one query and evaluates ranks in one pass
+        """
+        stat_user_ids, stats = await self.stats.get_all_users(RankTable.STATS)
+        table = self.get_table()
+        # Users without stat rows get rank of zero stats
+        default = table.name(table.evaluate({name: np.zeros(1, dtype=np.int64) for name in RankTable.STATS})[0])
+        ranks = {user_id: default for user_id in user_ids}
+        for user_id, index in zip(stat_user_ids.tolist(), table.evaluate(stats).tolist()):
+            if user_id in ranks:
+                ranks[user_id] = table.name(index)
+        return ranks
+
+    def role_index(self, role_name: str) -> int:
+        return self.roles.role_rows_did_map[self.roles.get(role_name).id]['idx']
+
+    def stale_mask(self, mask: Optional[str]) -> bool:
+        # Mask built before guild roles changed, role indexes may be shifted
+        return mask is None or len(mask) != len(self.roles.role_rows_did_map)
+
+    def ignore_mask(self, mask: str) -> bool:
+        if self.stale_mask(mask):
+            return True
+        ignored = any(mask[self.role_index(r)] == '1' for r in self.config["ignore"])
+        required = any(mask[self.role_index(r)] == '1' for r in self.config["require"])
+        return ignored or not required
+
+    async def plan_rank_changes(self, users: List[tuple]) -> List[RankChange]:
+        """
+            Diffs effective ranks against stored role masks
+
+            `users` are (id, did, roles) rows. Only users which
+            rank roles differ get into the plan, users with stale
+            masks are skipped
+        """
+        ranks = await self.find_user_rank_names([user.id for user in users])
+        rank_index = {name: self.role_index(name) for name in self.config["role"]}
+        plan = []
+        for user in users:
+            if self.ignore_mask(user.roles):
+                continue
+            current = {name for name, idx in rank_index.items() if user.roles[idx] == '1'}
+            desired = {ranks[user.id]} if ranks[user.id] is not None else set()
+            if current == desired:
+                continue
+            mask = list(user.roles)
+            for name in current - desired:
+                mask[rank_index[name]] = '0'
+            for name in desired - current:
+                mask[rank_index[name]] = '1'
+            plan.append(RankChange(user.id, user.did, sorted(desired - current), sorted(current - desired), ''.join(mask)))
+        return plan
 
     def ignore_member(self, member: discord.Member) -> bool:
         return len(filter_roles(member, self.config["ignore"])) > 0 or len(filter_roles(member, self.config["require"])) == 0
 
-    def roles_to_add_and_remove(self, member: discord.Member, user: DB.User) -> List[discord.Role]:
+    async def roles_to_add_and_remove(self, member: discord.Member, user: DB.User) -> List[discord.Role]:
+        return self.rank_roles_diff(member, await self.find_user_rank_name(user))
+
+    def rank_roles_diff(self, member: discord.Member, effective_rank_name: Optional[str]) -> List[discord.Role]:
         rank_roles = [self.roles.get(r) for r in self.config['role']]
         applied_rank_roles = filter_roles(member, rank_roles)
-        effective_rank_name = self.find_user_rank_name(user)
         ranks_to_remove = [r for r in applied_rank_roles if r.name != effective_rank_name]
         ranks_to_apply = []
         if effective_rank_name is not None and not is_role_applied(member, effective_rank_name):
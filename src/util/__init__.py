@@ -15,6 +15,11 @@ __author__ = 'Mathtin'
 
 from .extbot import *
 from .config import ConfigView
+from .cache import LRUCache
+from .bloom import BloomFilter, ScalableBloomFilter
+from .scheduler import RoleMutationScheduler, DebounceScheduler
+from .locks import LockManager
+from .buffer import EventBuffer
 from .exceptions import InvalidConfigException, NotCoroutineException
 from .resources import get as get_resource
 
@@ -36,6 +41,10 @@ def get_module_element(path: str):
     module = __module_cache[module_name]
     return getattr(module, object_name)
 
+def chunks(values: list, size: int):
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
 def dict_fancy_table(values: dict, key_name='name'):
     if not values:
         return '++\n'*2
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+
+import math
+
+from hashlib import blake2b
+
+
+class BloomFilter(object):
+    """
+        Probabilistic set of integer keys
+
+        Membership test never gives false negatives, false positive
+        rate stays near `error_rate` until `capacity` keys are added
+    """
+
+    __bits: bytearray
+
+    capacity:   int
+    size:       int
+    nbits:      int
+    nhashes:    int
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.nbits = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.nhashes = max(int(round(self.nbits / self.capacity * math.log(2))), 1)
+        self.__bits = bytearray((self.nbits + 7) // 8)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __positions(self, key: int):
+        # Double hashing: h1 + i * h2
+        digest = blake2b(key.to_bytes(16, 'little', signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, key: int):
+        for pos in self.__positions(key):
+            self.__bits[pos >> 3] |= 1 << (pos & 7)
+        self.size += 1
+
+    def __contains__(self, key: int) -> bool:
+        return all(self.__bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key))
+
+    def saturated(self) -> bool:
+        return self.size > self.capacity
+
+    def clear(self):
+        self.__bits = bytearray(len(self.__bits))
+        self.size = 0
+
+
+class ScalableBloomFilter(object):
+    """
+        Bloom filter growing with its key set
+
+        New stage with larger capacity and tighter error rate is added
+        once the last one is saturated, so overall false positive rate
+        stays bounded by `error_rate` regardless of key count
+    """
+
+    __stages: list
+
+    initial_capacity:   int
+    error_rate:         float
+    growth:             int
+    tightening:         float
+
+    def __init__(self, initial_capacity: int, error_rate: float = 0.01, growth: int = 2, tightening: float = 0.5):
+        self.initial_capacity = max(initial_capacity, 1)
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def size(self) -> int:
+        return sum(stage.size for stage in self.__stages)
+
+    @property
+    def capacity(self) -> int:
+        return sum(stage.capacity for stage in self.__stages)
+
+    @property
+    def stages(self) -> int:
+        return len(self.__stages)
+
+    def __stage(self, n: int) -> BloomFilter:
+        # Geometric series of stage error rates sums up to `error_rate`
+        capacity = self.initial_capacity * self.growth ** n
+        return BloomFilter(capacity, self.error_rate * (1 - self.tightening) * self.tightening ** n)
+
+    def add(self, key: int):
+        if key in self:
+            return
+        last = self.__stages[-1]
+        if last.size >= last.capacity:
+            last = self.__stage(len(self.__stages))
+            self.__stages.append(last)
+        last.add(key)
+
+    def __contains__(self, key: int) -> bool:
+        return any(key in stage for stage in reversed(self.__stages))
+
+    def saturated(self) -> bool:
+        return False
+
+    def clear(self):
+        self.__stages = [self.__stage(0)]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+
+from collections import deque
+from typing import Any, List
+
+
+class EventBuffer(object):
+    """
+        Bounded FIFO of deferred events
+
+        Oldest entries are dropped once capacity is reached,
+        drop count is kept until reset
+    """
+
+    __items: deque
+
+    capacity: int
+    dropped: int
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.__items = deque()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.__items)
+
+    def push(self, item: Any):
+        self.__items.append(item)
+        while len(self.__items) > self.capacity:
+            self.__items.popleft()
+            self.dropped += 1
+
+    def drain(self) -> List[Any]:
+        items = list(self.__items)
+        self.__items.clear()
+        return items
+
+    def reset_dropped(self) -> int:
+        dropped, self.dropped = self.dropped, 0
+        return dropped
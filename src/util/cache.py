@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+        Bounded mapping with least recently used eviction
+
+        `on_evict(key, value)` is called for every entry pushed out by capacity
+    """
+
+    __data: OrderedDict
+
+    capacity: int
+    hits: int
+    misses: int
+
+    def __init__(self, capacity: int, on_evict=None):
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.__data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __iter__(self):
+        return iter(list(self.__data.keys()))
+
+    def get(self, key, default=None):
+        if key not in self.__data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.__data.move_to_end(key)
+        return self.__data[key]
+
+    def peek(self, key, default=None):
+        return self.__data.get(key, default)
+
+    def put(self, key, value):
+        self.__data[key] = value
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.capacity:
+            old_key, old_value = self.__data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        return self.__data.pop(key, default)
+
+    def items(self):
+        return list(self.__data.items())
+
+    def clear(self):
+        self.__data.clear()
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
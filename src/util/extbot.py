@@ -64,9 +64,8 @@ def member_mention_arg(func):
             if user is None:
                 await msg.channel.send(get_resource("messages.unknown_user"))
                 return
-            try:
-                member = await client.guild.fetch_member(user.id)
-            except discord.NotFound:
+            member = await client.resolve_member(user.id)
+            if member is None:
                 await msg.channel.send(get_resource("messages.not_member_user"))
                 return
         else:
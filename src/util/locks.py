@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Hashable
+
+
+class LockManager(object):
+    """
+        Keyed asyncio locks with guild-wide exclusive mode
+
+        Holders of different keys run concurrently. Exclusive holder
+        waits for every keyed holder to leave and blocks new ones
+    """
+
+    __locks: Dict[Hashable, asyncio.Lock]
+    __refs: Dict[Hashable, int]
+    __changed: asyncio.Event
+
+    shared: int
+    exclusive_waiting: int
+    exclusive_held: bool
+
+    def __init__(self):
+        self.__locks = {}
+        self.__refs = {}
+        self.__changed = asyncio.Event()
+        self.shared = 0
+        self.exclusive_waiting = 0
+        self.exclusive_held = False
+
+    def locked(self) -> bool:
+        return self.exclusive_held
+
+    def __notify(self):
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+    async def __wait(self, predicate: Callable[[], bool]):
+        while not predicate():
+            await self.__changed.wait()
+
+    def __ref(self, key: Hashable) -> asyncio.Lock:
+        if key not in self.__locks:
+            self.__locks[key] = asyncio.Lock()
+            self.__refs[key] = 0
+        self.__refs[key] += 1
+        return self.__locks[key]
+
+    def __unref(self, key: Hashable):
+        self.__refs[key] -= 1
+        if self.__refs[key] == 0:
+            del self.__refs[key]
+            del self.__locks[key]
+
+    @asynccontextmanager
+    async def acquire(self, *keys: Hashable):
+        """
+            Locks given keys, e.g. ('user', did) or ('channel', id)
+
+            Keys are taken in stable order, so overlapping sets can't deadlock
+        """
+        # Pending exclusive goes first
+        await self.__wait(lambda: not self.exclusive_held and self.exclusive_waiting == 0)
+        self.shared += 1
+        keys = sorted(set(keys), key=repr)
+        locks = [self.__ref(key) for key in keys]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key in keys:
+                self.__unref(key)
+            self.shared -= 1
+            self.__notify()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        """
+            Locks whole guild state
+        """
+        self.exclusive_waiting += 1
+        try:
+            await self.__wait(lambda: not self.exclusive_held and self.shared == 0)
+        finally:
+            self.exclusive_waiting -= 1
+            self.__notify()
+        self.exclusive_held = True
+        try:
+            yield
+        finally:
+            self.exclusive_held = False
+            self.__notify()
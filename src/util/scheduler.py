@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###################################################
+#........../\./\...___......|\.|..../...\.........#
+#........./..|..\/\.|.|_|._.|.\|....|.c.|.........#
+#......../....../--\|.|.|.|i|..|....\.../.........#
+#        Mathtin (c)                              #
+###################################################
+#   Author: Daniel [Mathtin] Shiko                #
+#   Copyright (c) 2020 <wdaniil@mail.ru>          #
+#   This file is released under the MIT license.  #
+###################################################
+
+__author__ = 'Mathtin'
+
+
+import asyncio
+import logging
+import discord
+
+from typing import AsyncContextManager, Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+
+
+class RoleMutationScheduler(object):
+    """
+        Applies member role changes with bounded concurrency
+
+        Only missing roles are added and only present ones are removed, so
+        roles changed concurrently by others are never reverted. Rate limits are handled by discord.py route buckets, requests failed
+        with server errors are retried with exponential backoff
+    """
+
+    log = logging.getLogger('role-scheduler')
+
+    concurrency:    int
+    retries:        int
+    retry_delay:    float
+
+    def __init__(self, concurrency: int = 4, retries: int = 3, retry_delay: float = 1.0):
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    async def mutate(self, member: discord.Member, add: List[discord.Role], remove: List[discord.Role]) -> bool:
+        # Change may be applied meanwhile
+        present = {role.id for role in member.roles}
+        add = [role for role in add if role.id not in present]
+        remove = [role for role in remove if role.id in present]
+        if not add and not remove:
+            return True
+        for attempt in range(self.retries + 1):
+            try:
+                # Per-role requests are idempotent, so retry may repeat them
+                if add:
+                    await member.add_roles(*add)
+                    add = []
+                if remove:
+                    await member.remove_roles(*remove)
+                return True
+            except (discord.Forbidden, discord.NotFound) as e:
+                RoleMutationScheduler.log.error(f'Failed to edit roles of {member}: {e}')
+                return False
+            except discord.HTTPException as e:
+                if e.status < 500 or attempt == self.retries:
+                    RoleMutationScheduler.log.error(f'Failed to edit roles of {member}: {e}')
+                    return False
+                RoleMutationScheduler.log.warn(f'Retrying roles edit of {member} ({attempt + 1}/{self.retries}): {e}')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        return False
+
+    async def run(self, mutations: List[Tuple[discord.Member, List[discord.Role], List[discord.Role]]],
+                  progress: Callable[[int, int, int], Awaitable] = None, progress_every: int = 100,
+                  guard: Callable[[discord.Member], AsyncContextManager] = None) -> List[bool]:
+        """
+            Applies (member, roles to add, roles to remove) mutations
+
+            `progress(done, failed, total)` is awaited every `progress_every`
+            finished mutations. Each mutation is made inside `guard(member)`
+            if given. Returns success flag per mutation
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        total, counts = len(mutations), [0, 0]
+
+        async def worker(member, add, remove):
+            async with semaphore:
+                if guard is None:
+                    ok = await self.mutate(member, add, remove)
+                else:
+                    async with guard(member):
+                        ok = await self.mutate(member, add, remove)
+            counts[0 if ok else 1] += 1
+            finished = counts[0] + counts[1]
+            if progress is not None and (finished % progress_every == 0 or finished == total):
+                await progress(counts[0], counts[1], total)
+            return ok
+
+        return await asyncio.gather(*[worker(*mutation) for mutation in mutations])
+
+
+class DebounceScheduler(object):
+    """
+        Runs callback for marked keys at most once per window
+
+        Marks made while key is pending are coalesced into one call,
+        key marked during its own call is scheduled for next window
+    """
+
+    log = logging.getLogger('debounce-scheduler')
+
+    window:     float
+    callback:   Callable[[Hashable], Awaitable]
+
+    __dirty:    Set[Hashable]
+    __tasks:    Dict[Hashable, asyncio.Task]
+
+    def __init__(self, callback: Callable[[Hashable], Awaitable], window: float):
+        self.callback = callback
+        self.window = window
+        self.__dirty = set()
+        self.__tasks = {}
+
+    def __len__(self):
+        return len(self.__dirty)
+
+    def mark(self, key: Hashable):
+        self.__dirty.add(key)
+        if key not in self.__tasks:
+            self.__tasks[key] = asyncio.ensure_future(self.__run(key))
+
+    async def __run(self, key: Hashable):
+        try:
+            await asyncio.sleep(self.window)
+            self.__dirty.discard(key)
+            await self.callback(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            DebounceScheduler.log.error(f'Failed to run debounced call for {key}: {e}')
+        finally:
+            del self.__tasks[key]
+        if key in self.__dirty:
+            self.__tasks[key] = asyncio.ensure_future(self.__run(key))
+
+    def cancel(self):
+        for task in list(self.__tasks.values()):
+            task.cancel()
+        self.__dirty.clear()